@@ -0,0 +1,224 @@
+""" autotune.py
+picks the micro-batch size of every resolution on this machine, instead of
+hand-editing dataloader.micro_batch_table.
+
+at each renew, the current G and D (in their fade-in state, the largest one of
+the resolution) run probe steps with increasing batch sizes, the divisors of the
+logical batch (so that accumulating micro-batches trains exactly the logical
+batch): the same losses as trainer.train, gradient penalty double-backward
+included. batch sizes whose
+peak memory would exceed the budget are not run; among the others, the one
+with the best throughput (images/sec) is used, the largest one on near-ties.
+results are cached on disk per (resolution, configuration, device), so the
+probes only run once.
+"""
+import os
+import json
+import time
+import hashlib
+
+import torch
+
+
+def peak_memory(func):
+    """ peak memory (MB) allocated while running func(), on top of what was already
+    allocated: from the allocator statistics on gpu, replayed from the profiler's
+    memory events on cpu. """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        base = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        func()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - base) / pow(2, 20)
+
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        func()
+    events = sorted(
+        (e.time_range.start, e.self_cpu_memory_usage)
+        for e in prof.events()
+        if e.self_cpu_memory_usage
+    )
+    current = peak = 0
+    for _, usage in events:
+        current = current + usage
+        peak = max(peak, current)
+    return peak / pow(2, 20)
+
+
+def device_name():
+    if torch.cuda.is_available():
+        return torch.cuda.get_device_name()
+    return "cpu{}".format(os.cpu_count())
+
+
+def available_memory():
+    """ memory (MB) that is not in use yet on the training device. """
+    if torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+        return free / pow(2, 20)
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable"):
+                return int(line.split()[1]) / 1024.0
+    return float("inf")
+
+
+def config_hash(config):
+    # everything that changes the size of the networks or of their activations.
+    keys = [
+        "nz",
+        "nc",
+        "ngf",
+        "ndf",
+        "flag_wn",
+        "flag_bn",
+        "flag_pixelwise",
+        "flag_gdrop",
+        "flag_leaky",
+        "flag_tanh",
+        "flag_sigmoid",
+        "flag_norm_latent",
+        "mbstd_group",
+        "precision",
+        "flag_channels_last",
+    ]
+    desc = json.dumps({k: getattr(config, k, None) for k in keys}, sort_keys=True)
+    return hashlib.sha1(desc.encode()).hexdigest()[:12]
+
+
+def probe_step(G, D, x, z, amp, wgan_lambda=10.0):
+    """ forward and backward passes of one D and one G update, without touching the
+    weights (no optimizer step). """
+    x = x.detach().requires_grad_(True)
+    with amp.autocast():
+        x_tilde = G(z)
+        fx = D(x).float()
+        fx_tilde = D(x_tilde.detach()).float()
+    loss_d = (fx - 1).pow(2).mean() + fx_tilde.pow(2).mean()
+    gradients = torch.autograd.grad(
+        outputs=amp.scale(fx),
+        inputs=x,
+        grad_outputs=torch.ones_like(fx),
+        create_graph=True,
+        retain_graph=True,
+    )[0]
+    gradients = amp.unscale(gradients).reshape(x.size(0), -1)
+    gradients_norm = torch.sqrt(torch.sum(gradients ** 2, dim=1) + 1e-12)
+    loss_d = loss_d + wgan_lambda * ((gradients_norm - 1) ** 2).mean()
+    amp.scale(loss_d).backward()
+    with amp.autocast():
+        loss_g = (D(x_tilde).float() - 1).pow(2).mean()
+    amp.scale(loss_g).backward()
+
+
+class batch_tuner:
+    def __init__(self, config, amp, memory_format=torch.contiguous_format):
+        """
+        budget_mb: memory a training step may allocate (0: a fraction
+        mem_fraction of the memory available when probing).
+        """
+        self.config = config
+        self.amp = amp
+        self.memory_format = memory_format
+        self.budget_mb = config.autotune_budget_mb
+        self.mem_fraction = config.autotune_mem_fraction
+        self.cache_path = os.path.join(config.data_cache, "autotune.json")
+        self.key_prefix = "{}|{}|{}".format(
+            self.budget_mb or "free{}".format(self.mem_fraction),
+            config_hash(config),
+            device_name(),
+        )
+        self.cache = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, "r") as f:
+                self.cache = json.load(f)
+
+    def budget(self, G, D):
+        if self.budget_mb > 0:
+            return self.budget_mb
+        # the adam moments of new blocks are not allocated yet: keep room for
+        # twice the parameters (the gradients are part of the probed peak).
+        reserve = 0
+        for p in list(G.parameters()) + list(D.parameters()):
+            reserve = reserve + 2 * p.numel() * p.element_size()
+        return self.mem_fraction * available_memory() - reserve / pow(2, 20)
+
+    def tune(self, G, D, imsize, max_batch, n_probe=2):
+        """ the fastest micro-batch size that fits in memory, among the divisors of
+        max_batch (the logical batch size). """
+        key = "{}|{}|{}".format(imsize, max_batch, self.key_prefix)
+        if key in self.cache and max_batch % self.cache[key]["batchsize"] == 0:
+            return self.cache[key]["batchsize"]
+
+        budget = self.budget(G, D)
+        device = next(G.parameters()).device
+        probes = []
+        candidates = [b for b in range(1, max_batch + 1) if max_batch % b == 0]
+        with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+            for batchsize in candidates:
+                if len(probes) >= 2:
+                    # peak memory grows linearly with the batch size.
+                    (b0, m0, _), (b1, m1, _) = probes[-2:]
+                    predicted = m1 + (m1 - m0) * (batchsize - b1) / (b1 - b0)
+                    if predicted > budget:
+                        break
+                probe = self.probe(G, D, imsize, batchsize, device, n_probe)
+                if probe is None or probe[1] > budget:
+                    break
+                probes.append(probe)
+        G.zero_grad(set_to_none=True)
+        D.zero_grad(set_to_none=True)
+
+        best = (1, None, None)
+        if probes:
+            # timings are noisy: the largest batch within 10% of the best throughput.
+            fastest = max(p[2] for p in probes)
+            best = [p for p in probes if p[2] >= 0.9 * fastest][-1]
+        print(
+            "[autotune] {}x{}: batch size {} (budget {:.0f}MB, probed {})".format(
+                imsize, imsize, best[0], budget, [p[0] for p in probes]
+            )
+        )
+        self.cache[key] = {
+            "batchsize": best[0],
+            "peak_mb": best[1],
+            "imgs_per_sec": best[2],
+            "budget_mb": budget,
+        }
+        self.write_cache()
+        return best[0]
+
+    def probe(self, G, D, imsize, batchsize, device, n_probe):
+        """ (batchsize, peak MB, images/sec), or None if it does not fit. """
+        x = torch.randn(batchsize, self.config.nc, imsize, imsize, device=device)
+        x = x.contiguous(memory_format=self.memory_format)
+        z = torch.randn(batchsize, self.config.nz, device=device)
+
+        def step():
+            G.zero_grad(set_to_none=True)
+            D.zero_grad(set_to_none=True)
+            probe_step(G, D, x, z, self.amp)
+
+        try:
+            peak = peak_memory(step)
+            start = time.perf_counter()
+            for _ in range(n_probe):
+                step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = (time.perf_counter() - start) / n_probe
+        except RuntimeError as e:  # out of memory.
+            if "out of memory" not in str(e):
+                raise
+            torch.cuda.empty_cache()
+            return None
+        return batchsize, peak, batchsize / elapsed
+
+    def write_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        with open(self.cache_path + ".tmp", "w") as f:
+            json.dump(self.cache, f, indent=1)
+        os.replace(self.cache_path + ".tmp", self.cache_path)
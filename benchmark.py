@@ -0,0 +1,1591 @@
+""" benchmark.py
+micro-benchmarks for the training pipeline.
+
+  $ python benchmark.py <name> [--bench_json out.json] [config options]
+
+results are printed as a table, and optionally written as json so that runs
+can be compared across commits (--bench_baseline previous.json prints the
+ratios to a previous run).
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from autotune import peak_memory
+from config import config
+
+benchmarks = {}
+
+
+def register(name):
+    def wrapper(func):
+        benchmarks[name] = func
+        return func
+
+    return wrapper
+
+
+def timeit(func, n_iter, n_warmup=1):
+    """ returns the mean wall-clock time of func() in seconds. """
+    for _ in range(n_warmup):
+        func()
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        func()
+    return (time.perf_counter() - start) / n_iter
+
+
+def allocated_memory(func):
+    """ total host memory (MB) allocated by the operators run in func(), whether
+    it is freed right away or not. """
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        func()
+    usage = [e.self_cpu_memory_usage for e in prof.key_averages()]
+    return sum(u for u in usage if u > 0) / pow(2, 20)
+
+
+def bench_config(small_dim=None, **options):
+    """ a copy of config with the given options set. benchmarks never modify the
+    shared config, so that they give the same results whichever ran before them.
+    small_dim: width of a toy network (ngf, ndf and nz). """
+    cfg = copy.copy(config)
+    if small_dim:
+        cfg.ngf = cfg.ndf = cfg.nz = small_dim
+    for name, value in options.items():
+        setattr(cfg, name, value)
+    return cfg
+
+
+def make_synthetic_folder(root, n_images, size=64):
+    """ writes random jpeg images in the ImageFolder layout expected by dataloader. """
+    folder = os.path.join(root, "synthetic")
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.RandomState(0)
+    for i in range(n_images):
+        arr = rng.randint(0, 256, size=(size, size, 3)).astype(np.uint8)
+        Image.fromarray(arr).save(os.path.join(folder, "{}.jpg".format(i)))
+    return root
+
+
+def synthetic_images(n, resl, seed=0):
+    """ smooth random images in [-1, 1], learnable at any resolution. """
+    gen = torch.Generator().manual_seed(seed)
+    x = torch.rand(n, 3, 4, 4, generator=gen).mul(2).add(-1)
+    return torch.nn.functional.interpolate(
+        x, size=(pow(2, resl), pow(2, resl)), mode="bilinear", align_corners=False
+    )
+
+
+def train_step(
+    G,
+    D,
+    opt_g,
+    opt_d,
+    x,
+    z,
+    wgan_lambda=10.0,
+    wgan_epsilon=0.001,
+    amp=None,
+    n_accum=1,
+    fused_d=False,
+    reg_weight=1.0,
+    reg_batch=None,
+):
+    """ one D and one G update, through the D and G steps of trainer.train. amp: a
+    mixed_precision.precision_policy (fp32 by default). n_accum: number of
+    micro-batches x and z are split into, accumulating their gradients.
+    fused_d: reals and fakes in a single D pass (--flag_fused_d). reg_weight:
+    weight of the penalties (0: none), computed on the first reg_batch reals of
+    each micro-batch (None: all of them). """
+    import dist_utils
+    import mixed_precision
+    from trainer import d_step_loss, g_step_loss
+
+    amp = amp or mixed_precision.precision_policy()
+    mse = torch.nn.MSELoss()
+    G.zero_grad()
+    D.zero_grad()
+    xs, zs = x.chunk(n_accum), z.chunk(n_accum)
+    loss_d_sum = loss_g_sum = 0.0
+    x_tildes = []
+    for x, z in zip(xs, zs):
+        real_label = torch.ones(x.size(0), device=x.device)
+        fake_label = torch.zeros(x.size(0), device=x.device)
+        loss_d, x_tilde, _, _ = d_step_loss(
+            G,
+            D,
+            x,
+            z,
+            real_label,
+            fake_label,
+            mse,
+            amp,
+            reg_weight,
+            reg_batch,
+            wgan_lambda,
+            wgan_epsilon,
+            fused=fused_d,
+            keep_g_graph=n_accum == 1,
+        )
+        x_tildes.append(x_tilde)
+        amp.scale(loss_d / n_accum).backward()
+        loss_d_sum = loss_d_sum + loss_d.item()
+    dist_utils.all_reduce_grads(D.parameters())
+    amp.step(opt_d)
+
+    for x_tilde, z in zip(x_tildes, zs):
+        real_label = torch.ones(z.size(0), device=z.device)
+        loss_g = g_step_loss(
+            G, D, x_tilde, z if n_accum > 1 else None, real_label, mse, amp
+        )
+        amp.scale(loss_g / n_accum).backward()
+        loss_g_sum = loss_g_sum + loss_g.item()
+    dist_utils.all_reduce_grads(G.parameters())
+    amp.step(opt_g)
+    amp.update()
+    return loss_d_sum / n_accum, loss_g_sum / n_accum
+
+
+## benchmarks.
+@register("dataloader")
+def bench_dataloader(args):
+    """ batches/sec of dataloader.get_batch, fresh iterator per step vs persistent stream. """
+    import dataloader as DL
+    from torch.utils.data import DataLoader
+
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        cfg = bench_config(train_data_root=make_synthetic_folder(root, args.n_images))
+        for resl in range(2, args.max_resl + 1):
+            loader = DL.dataloader(cfg)
+            loader.num_workers = args.num_workers
+            loader.renew(resl)
+
+            # the previous get_batch: a fresh (non-persistent) iterator per step.
+            old_loader = DataLoader(
+                dataset=loader.dataset,
+                batch_size=loader.batchsize,
+                shuffle=True,
+                num_workers=loader.num_workers,
+            )
+
+            def old_path():
+                next(iter(old_loader))[0].mul(2).add(-1)
+
+            t_old = timeit(old_path, args.n_iter)
+            t_new = timeit(loader.get_batch, args.n_iter)
+            rows.append(
+                {
+                    "resl": pow(2, resl),
+                    "batchsize": loader.batchsize,
+                    "old_batches_per_sec": 1.0 / t_old,
+                    "new_batches_per_sec": 1.0 / t_new,
+                    "speedup": t_old / t_new,
+                }
+            )
+            del loader, old_loader
+    return rows
+
+
+@register("uint8")
+def bench_uint8(args):
+    """ float32 vs. uint8 images out of the dataloader workers (ImageFolder and
+    pyramid cache): bytes per batch sent by the workers, batches/sec of
+    get_batch, and the difference of the [-1, 1] images. """
+    import dataloader as DL
+
+    rows = []
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as cache:
+        folder = make_synthetic_folder(root, args.n_images)
+        for pyramid in [False, True]:
+            for resl in range(2, args.max_resl + 1):
+                results = {}
+                for uint8 in [False, True]:
+                    cfg = bench_config(
+                        train_data_root=folder,
+                        data_cache=cache,
+                        flag_pyramid_cache=pyramid,
+                        flag_uint8_data=uint8,
+                    )
+                    loader = DL.dataloader(cfg)
+                    loader.num_workers = args.num_workers
+                    loader.renew(resl)
+                    batch = loader.next_batch()[0]
+                    first = torch.stack([loader.dataset[i][0] for i in range(4)])
+                    if uint8:
+                        first = torch.add(torch.tensor(-1.0), first, alpha=2.0 / 255)
+                    else:
+                        first = first.mul(2).add(-1)
+                    results[uint8] = (
+                        batch.numel() * batch.element_size(),
+                        timeit(loader.get_batch, args.n_iter),
+                        first,
+                    )
+                    del loader
+                rows.append(
+                    {
+                        "resl": pow(2, resl),
+                        "source": "pyramid" if pyramid else "folder",
+                        "float_kb": results[False][0] / 1024.0,
+                        "uint8_kb": results[True][0] / 1024.0,
+                        "float_batches_per_sec": 1.0 / results[False][1],
+                        "uint8_batches_per_sec": 1.0 / results[True][1],
+                        "speedup": results[False][1] / results[True][1],
+                        "max_abs_diff": (results[False][2] - results[True][2])
+                        .abs()
+                        .max()
+                        .item(),
+                    }
+                )
+    return rows
+
+
+@register("pyramid")
+def bench_pyramid(args):
+    """ batches/sec of ImageFolder (decode + resize) vs. the pyramid cache, per resolution. """
+    import dataloader as DL
+
+    rows = []
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as cache:
+        data = make_synthetic_folder(root, args.n_images, pow(2, args.max_resl))
+        start = time.perf_counter()
+        cached = DL.dataloader(
+            bench_config(
+                train_data_root=data, data_cache=cache, flag_pyramid_cache=True
+            )
+        )
+        t_build = time.perf_counter() - start
+        folder = DL.dataloader(
+            bench_config(
+                train_data_root=data, data_cache=cache, flag_pyramid_cache=False
+            )
+        )
+        for resl in range(2, args.max_resl + 1):
+            for loader in [folder, cached]:
+                loader.num_workers = args.num_workers
+                loader.renew(resl)
+            # both paths must produce the same pixels.
+            img_a, _ = folder.dataset[0]
+            img_b, _ = cached.dataset[0]
+            t_folder = timeit(folder.get_batch, args.n_iter)
+            t_cached = timeit(cached.get_batch, args.n_iter)
+            rows.append(
+                {
+                    "resl": pow(2, resl),
+                    "batchsize": folder.batchsize,
+                    "build_sec": t_build,
+                    "folder_batches_per_sec": 1.0 / t_folder,
+                    "cache_batches_per_sec": 1.0 / t_cached,
+                    "speedup": t_folder / t_cached,
+                    "max_abs_diff": (img_a - img_b).abs().max().item(),
+                }
+            )
+        del folder, cached
+    return rows
+
+
+def pil_interpolated_input(x, alpha):
+    """ the previous feed_interpolated_input: x blended with its nearest
+    down/up-sampled copy, one PIL round-trip per image (which quantizes the
+    copy to 8 bits). transforms.Scale is now transforms.Resize. """
+    import torchvision.transforms as transforms
+
+    imsize = x.size(-1)
+    transform = transforms.Compose(
+        [
+            transforms.ToPILImage(),
+            transforms.Resize(size=imsize // 2, interpolation=Image.NEAREST),
+            transforms.Resize(size=imsize, interpolation=Image.NEAREST),
+            transforms.ToTensor(),
+        ]
+    )
+    x_low = x.clone().add(1).mul(0.5)
+    for i in range(x_low.size(0)):
+        x_low[i] = transform(x_low[i]).mul(2).add(-1)
+    return torch.add(x.mul(alpha), x_low.mul(1 - alpha))
+
+
+@register("interp")
+def bench_interp(args):
+    """ feed_interpolated_input: per-image PIL round-trip vs. batched tensor ops
+    (checks.py interp checks that they match). """
+    import dataloader as DL
+    from trainer import interpolate_low_resl
+
+    rows = []
+    table = DL.dataloader(config).batch_table
+    for resl in range(3, args.max_resl + 1):
+        imsize = pow(2, resl)
+        x = torch.rand(table[imsize], 3, imsize, imsize).mul(2).add(-1)
+        alpha = 0.3
+
+        def old_path():
+            return pil_interpolated_input(x, alpha)
+
+        def new_path():
+            return torch.lerp(interpolate_low_resl(x), x, alpha)
+
+        t_old = timeit(old_path, args.n_iter)
+        t_new = timeit(new_path, args.n_iter)
+        rows.append(
+            {
+                "resl": imsize,
+                "batchsize": x.size(0),
+                "old_ms": t_old * 1000,
+                "new_ms": t_new * 1000,
+                "speedup": t_old / t_new,
+                # the old path quantized x_low to 8 bits through PIL.
+                "max_abs_diff": (old_path() - new_path()).abs().max().item(),
+            }
+        )
+    return rows
+
+
+def build_networks(cfg, resl, fadein=False):
+    """ G and D of cfg grown up to resl, flushed (or left in the fade-in state). """
+    import network as net
+
+    G = net.Generator(cfg)
+    D = net.Discriminator(cfg)
+    for r in range(3, resl + 1):
+        G.grow_network(r)
+        D.grow_network(r)
+        if r < resl or not fadein:
+            G.flush_network()
+            D.flush_network()
+    return G, D
+
+
+@register("ema")
+def bench_ema(args):
+    """ cost of one smoothed-generator update: per-parameter .data = .mul().add() vs. fused lerp. """
+    import network as net
+
+    def old_soft_copy_param(target_link, source_link, tau):
+        target_params = dict(target_link.named_parameters())
+        for param_name, param in source_link.named_parameters():
+            target_params[param_name].data = target_params[param_name].data.mul(
+                1.0 - tau
+            )
+            target_params[param_name].data = target_params[param_name].data.add(
+                param.data.mul(tau)
+            )
+
+    rows = []
+    for resl in range(2, args.max_resl + 1):
+        G, _ = build_networks(config, resl)
+        Gs = copy.deepcopy(G)
+        tau = 1.0 - config.smoothing
+        t_old = timeit(lambda: old_soft_copy_param(Gs, G, tau), args.n_iter)
+        t_new = timeit(lambda: net.soft_copy_param(Gs, G, tau), args.n_iter)
+        rows.append(
+            {
+                "resl": pow(2, resl),
+                "n_params": sum(p.numel() for p in G.parameters()),
+                "n_tensors": len(list(G.parameters())),
+                "old_ms": t_old * 1000,
+                "new_ms": t_new * 1000,
+                "speedup": t_old / t_new,
+            }
+        )
+    return rows
+
+
+def old_wrap_module(module, target):
+    """ the previous deepcopy_module: nn.Sequential holding the child named target
+    of module, with its weights copied (onto themselves). """
+    import torch.nn as nn
+
+    new_module = nn.Sequential()
+    for name, m in module.named_children():
+        if name == target:
+            new_module.add_module(name, m)
+            new_module[-1].load_state_dict(m.state_dict())
+    return new_module
+
+
+def old_rebuild(model, skip, head=(), tail=()):
+    """ the previous way of changing the blocks of a network: a new nn.Sequential
+    of head + the children of model not in skip + tail, copying the weights of
+    every kept child. """
+    import torch.nn as nn
+
+    new_model = nn.Sequential()
+    for name, module in head:
+        new_model.add_module(name, module)
+    for name, module in model.named_children():
+        if name not in skip:
+            new_model.add_module(name, module)
+            new_model[-1].load_state_dict(module.state_dict())
+    for name, module in tail:
+        new_model.add_module(name, module)
+    return new_model
+
+
+def old_grow_network(model, resl):
+    """ the previous grow_network of a Generator or a Discriminator. """
+    import torch.nn as nn
+    import network as net
+
+    if not (resl >= 3 and resl <= 9):
+        return
+    if isinstance(model, net.Generator):
+        prev_block = nn.Sequential()
+        prev_block.add_module(
+            "low_resl_upsample", nn.Upsample(scale_factor=2, mode="nearest")
+        )
+        prev_block.add_module(
+            "low_resl_to_rgb", old_wrap_module(model.model, "to_rgb_block")
+        )
+        inter_block, ndim, model.layer_name = model.intermediate_block(resl)
+        next_block = nn.Sequential()
+        next_block.add_module("high_resl_block", inter_block)
+        next_block.add_module("high_resl_to_rgb", model.to_rgb_block(ndim))
+        model.model = old_rebuild(
+            model.model,
+            ["to_rgb_block"],
+            tail=[
+                ("concat_block", net.ConcatTable(prev_block, next_block)),
+                ("fadein_block", net.fadein_layer(model.config)),
+            ],
+        )
+    else:
+        prev_block = nn.Sequential()
+        prev_block.add_module("low_resl_downsample", nn.AvgPool2d(kernel_size=2))
+        prev_block.add_module(
+            "low_resl_from_rgb", old_wrap_module(model.model, "from_rgb_block")
+        )
+        inter_block, ndim, model.layer_name = model.intermediate_block(resl)
+        next_block = nn.Sequential()
+        next_block.add_module("high_resl_from_rgb", model.from_rgb_block(ndim))
+        next_block.add_module("high_resl_block", inter_block)
+        model.model = old_rebuild(
+            model.model,
+            ["from_rgb_block"],
+            head=[
+                ("concat_block", net.ConcatTable(prev_block, next_block)),
+                ("fadein_block", net.fadein_layer(model.config)),
+            ],
+        )
+    model.module_names = net.get_module_names(model.model)
+
+
+def old_flush_network(model):
+    """ the previous flush_network of a Generator or a Discriminator. """
+    import network as net
+
+    if not hasattr(model.model, "concat_block"):
+        return
+    layer2 = model.model.concat_block.layer2
+    skip = ["concat_block", "fadein_block"]
+    block = (model.layer_name, old_wrap_module(layer2, "high_resl_block"))
+    if isinstance(model, net.Generator):
+        to_rgb = ("to_rgb_block", old_wrap_module(layer2, "high_resl_to_rgb"))
+        model.model = old_rebuild(model.model, skip, tail=[block, to_rgb])
+    else:
+        from_rgb = ("from_rgb_block", old_wrap_module(layer2, "high_resl_from_rgb"))
+        model.model = old_rebuild(model.model, skip, head=[from_rgb, block])
+    model.module_names = net.get_module_names(model.model)
+
+
+@register("grow")
+def bench_grow(args):
+    """ time of grow_network + flush_network for G and D, previous (rebuilt
+    containers, copied weights) vs. spliced blocks. checks.py grow checks that
+    both give the same networks, and that existing parameters are reused. """
+    import network as net
+
+    def timed(func, nets):
+        start = time.perf_counter()
+        for model in nets:
+            func(model)
+        return time.perf_counter() - start
+
+    def param_ids(nets):
+        return {id(p) for model in nets for p in model.parameters()}
+
+    rows = []
+    new = [net.Generator(config), net.Discriminator(config)]
+    old = [net.Generator(config), net.Discriminator(config)]
+    for resl in range(3, 10):
+        before = param_ids(new)
+        t_old_grow = timed(lambda model: old_grow_network(model, resl), old)
+        t_grow = timed(lambda model: model.grow_network(resl), new)
+        grown = param_ids(new)
+        t_old_flush = timed(old_flush_network, old)
+        t_flush = timed(lambda model: model.flush_network(), new)
+        flushed = param_ids(new)
+        rows.append(
+            {
+                "resl": pow(2, resl),
+                "reused_params": len(before & grown),
+                "new_params": len(grown - before),
+                "dropped_params": len(grown - flushed),
+                "old_grow_ms": t_old_grow * 1000,
+                "grow_ms": t_grow * 1000,
+                "old_flush_ms": t_old_flush * 1000,
+                "flush_ms": t_flush * 1000,
+            }
+        )
+    return rows
+
+
+@register("optim_carry")
+def bench_optim_carry(args):
+    """ iterations needed after growing 4x4 --> 8x8 for the smoothed losses to get
+    back to their pre-growth level, with and without optimizer state carry-over. """
+    import network as net
+    import optim_utils
+    from torch.optim import Adam
+
+    torch.manual_seed(0)
+    cfg = bench_config(args.small_dim)
+    G = net.Generator(cfg)
+    D = net.Discriminator(cfg)
+    betas = (cfg.beta1, cfg.beta2)
+    opt_g = Adam(G.parameters(), lr=cfg.lr, betas=betas)
+    opt_d = Adam(D.parameters(), lr=cfg.lr, betas=betas)
+    data = {r: synthetic_images(args.n_images, r) for r in [2, 3]}
+
+    def batches(resl, n_steps, seed):
+        gen = torch.Generator().manual_seed(seed)
+        for _ in range(n_steps):
+            idx = torch.randint(0, args.n_images, (args.batchsize,), generator=gen)
+            yield data[resl][idx], torch.randn(args.batchsize, cfg.nz, generator=gen)
+
+    history = []
+    for x, z in batches(2, args.n_steps, 1):
+        history.append(train_step(G, D, opt_g, opt_d, x, z))
+    before = np.mean(history[-args.window :], axis=0)
+
+    rows = []
+    for carry in [False, True]:
+        torch.manual_seed(1)
+        g, d = copy.deepcopy(G), copy.deepcopy(D)
+        o_g = Adam(g.parameters(), lr=cfg.lr, betas=betas)
+        o_d = Adam(d.parameters(), lr=cfg.lr, betas=betas)
+        o_g.load_state_dict(opt_g.state_dict())
+        o_d.load_state_dict(opt_d.state_dict())
+        g.grow_network(3)
+        d.grow_network(3)
+        if carry:
+            optim_utils.sync_param_groups(o_g, g.parameters())
+            optim_utils.sync_param_groups(o_d, d.parameters())
+        else:
+            o_g = Adam(g.parameters(), lr=cfg.lr, betas=betas)
+            o_d = Adam(d.parameters(), lr=cfg.lr, betas=betas)
+
+        recovered = [None, None]
+        ema = None
+        after = []
+        for i, (x, z) in enumerate(batches(3, args.n_steps, 2)):
+            for fadein in [g.model.fadein_block, d.model.fadein_block]:
+                fadein.update_alpha(2.0 / args.n_steps)  # fade-in over half the run.
+            loss = np.array(train_step(g, d, o_g, o_d, x, z))
+            after.append(loss)
+            ema = loss if ema is None else 0.9 * ema + 0.1 * loss
+            for k in range(2):
+                if recovered[k] is None and i >= args.window and ema[k] <= before[k]:
+                    recovered[k] = i + 1
+        rows.append(
+            {
+                "carry_over": carry,
+                "loss_d_before": float(before[0]),
+                "loss_g_before": float(before[1]),
+                "loss_d_after": float(np.mean(after[: args.window], axis=0)[0]),
+                "loss_g_after": float(np.mean(after[: args.window], axis=0)[1]),
+                "iters_to_recover_d": recovered[0] or -1,  # -1: not recovered.
+                "iters_to_recover_g": recovered[1] or -1,
+            }
+        )
+    return rows
+
+
+class old_equalized_layers:
+    """ context manager restoring the previous equalized layers, which scaled the
+    input and added the bias in separate ops. """
+
+    def __init__(self):
+        import custom_layers as cl
+
+        def conv_forward(self, x):
+            x = self.conv(x.mul(self.scale))
+            return x + self.bias.view(1, -1, 1, 1).expand_as(x)
+
+        def deconv_forward(self, x):
+            x = self.deconv(x.mul(self.scale))
+            return x + self.bias.view(1, -1, 1, 1).expand_as(x)
+
+        def linear_forward(self, x):
+            x = self.linear(x.mul(self.scale))
+            return x + self.bias.view(1, -1).expand_as(x)
+
+        self.patches = [
+            (cl.equalized_conv2d, conv_forward),
+            (cl.equalized_deconv2d, deconv_forward),
+            (cl.equalized_linear, linear_forward),
+        ]
+
+    def __enter__(self):
+        self.saved = [(cls, cls.forward) for cls, _ in self.patches]
+        for cls, forward in self.patches:
+            cls.forward = forward
+
+    def __exit__(self, *exc):
+        for cls, forward in self.saved:
+            cls.forward = forward
+
+
+@register("layers")
+def bench_layers(args):
+    """ forward + backward of the equalized layers, previous (scaled input, separate
+    bias add) vs. fused (scale on the smaller operand, bias in the kernel): time,
+    memory allocated and output difference, for the layers of the newest blocks
+    and the whole G / D. """
+    import custom_layers as cl
+
+    equalized = (cl.equalized_conv2d, cl.equalized_deconv2d, cl.equalized_linear)
+    rows = []
+    for resl in range(2, args.max_resl + 1):
+        G, D = build_networks(config, resl)
+        z = torch.randn(args.batchsize, config.nz)
+        x = torch.randn(args.batchsize, 3, pow(2, resl), pow(2, resl))
+
+        # inputs of every equalized layer, recorded with forward hooks.
+        inputs = {}
+        hooks = []
+        for prefix, model in [("G", G), ("D", D)]:
+            for name, m in model.named_modules():
+                if isinstance(m, equalized):
+                    key = "{}.{}".format(prefix, name)
+                    hooks.append(
+                        m.register_forward_hook(
+                            lambda m, i, o, key=key: inputs.update({key: (m, i[0])})
+                        )
+                    )
+        with torch.no_grad():
+            D(G(z))
+        for h in hooks:
+            h.remove()
+        # newest blocks (and to_rgb / from_rgb) only: the others were measured
+        # at lower resolutions.
+        newest = ["G.model.{}.".format(n) for n in list(G.model._modules)[-2:]]
+        newest += ["D.model.{}.".format(n) for n in list(D.model._modules)[:2]]
+        cases = [
+            (key, m, inp.detach())
+            for key, (m, inp) in inputs.items()
+            if any(key.startswith(n) for n in newest)
+        ]
+        cases.append(("G", G, z))
+        cases.append(("D", D, x))
+
+        for key, module, inp in cases:
+            inp = inp.clone().requires_grad_(True)
+
+            def step():
+                out = module(inp)
+                out.backward(torch.ones_like(out))
+                return out.detach()
+
+            with old_equalized_layers():
+                out_old = step()
+                t_old = timeit(step, args.n_iter)
+                mem_old = allocated_memory(step)
+            out_new = step()
+            t_new = timeit(step, args.n_iter)
+            mem_new = allocated_memory(step)
+            module.zero_grad()
+            rows.append(
+                {
+                    "resl": pow(2, resl),
+                    "layer": key,
+                    "old_ms": t_old * 1000,
+                    "new_ms": t_new * 1000,
+                    "speedup": t_old / t_new,
+                    "old_alloc_mb": mem_old,
+                    "new_alloc_mb": mem_new,
+                    "max_abs_diff": (out_old - out_new).abs().max().item(),
+                }
+            )
+    return rows
+
+
+@register("precision")
+def bench_precision(args):
+    """ training step time and peak memory per resolution, fp32 vs. the mixed
+    precision modes, each in NCHW and channels-last layout. """
+    import mixed_precision
+    from torch.optim import Adam
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    modes = ["fp32", "bf16"] + (["fp16"] if device == "cuda" else [])
+    rows = []
+    for resl in range(2, args.max_resl + 1):
+        baseline = None
+        for precision in modes:
+            for channels_last in [False, True]:
+                fmt = torch.channels_last if channels_last else torch.contiguous_format
+                torch.manual_seed(0)
+                G, D = build_networks(config, resl)
+                G = G.to(device, memory_format=fmt)
+                D = D.to(device, memory_format=fmt)
+                opt_g = Adam(G.parameters(), lr=config.lr, betas=(0.0, 0.99))
+                opt_d = Adam(D.parameters(), lr=config.lr, betas=(0.0, 0.99))
+                amp = mixed_precision.precision_policy(precision, device)
+                x = synthetic_images(args.batchsize, resl).to(device)
+                x = x.contiguous(memory_format=fmt)
+                z = torch.randn(args.batchsize, config.nz, device=device)
+
+                def step():
+                    train_step(G, D, opt_g, opt_d, x, z, amp=amp)
+
+                t = timeit(step, args.n_iter)
+                if baseline is None:
+                    baseline = t
+                rows.append(
+                    {
+                        "resl": pow(2, resl),
+                        "device": device,
+                        "precision": amp.name,
+                        "channels_last": channels_last,
+                        "step_ms": t * 1000,
+                        "peak_mb": peak_memory(step),
+                        "speedup": baseline / t,
+                    }
+                )
+                del G, D, opt_g, opt_d
+    return rows
+
+
+@register("network")
+def bench_network(args):
+    """ G and D of every stage, fade-in and flushed, at --ngf/--ndf/--nz and
+    --batchsize: forward and backward latency, gradient penalty (D step) and full
+    training step latency, and the peak memory of a training step. """
+    from torch.optim import Adam
+
+    rows = []
+    for resl in range(2, args.max_resl + 1):
+        for fadein in [True, False] if resl > 2 else [False]:
+            torch.manual_seed(0)
+            G, D = build_networks(config, resl, fadein=fadein)
+            opt_g = Adam(G.parameters(), lr=config.lr, betas=(0.0, 0.99))
+            opt_d = Adam(D.parameters(), lr=config.lr, betas=(0.0, 0.99))
+            x = synthetic_images(args.batchsize, resl)
+            z = torch.randn(args.batchsize, config.nz)
+
+            def forward():
+                return D(G(z)).mean()
+
+            def forward_backward():
+                forward().backward()
+
+            def gradient_penalty():
+                # the D step of train_step, without the optimizer.
+                x_in = x.detach().requires_grad_(True)
+                fx = D(x_in)
+                gradients = torch.autograd.grad(
+                    outputs=fx,
+                    inputs=x_in,
+                    grad_outputs=torch.ones_like(fx),
+                    create_graph=True,
+                    retain_graph=True,
+                )[0]
+                norm = gradients.reshape(x.size(0), -1).norm(dim=1)
+                (fx.mean() + 10.0 * ((norm - 1) ** 2).mean()).backward()
+
+            def step():
+                train_step(G, D, opt_g, opt_d, x, z)
+
+            t_fwd = timeit(forward, args.n_iter)
+            t_fwd_bwd = timeit(forward_backward, args.n_iter)
+            rows.append(
+                {
+                    "resl": pow(2, resl),
+                    "state": "fadein" if fadein else "flushed",
+                    "params_m": sum(
+                        p.numel() for p in list(G.parameters()) + list(D.parameters())
+                    )
+                    / 1e6,
+                    "forward_ms": t_fwd * 1000,
+                    "backward_ms": (t_fwd_bwd - t_fwd) * 1000,
+                    "gp_ms": timeit(gradient_penalty, args.n_iter) * 1000,
+                    "step_ms": timeit(step, args.n_iter) * 1000,
+                    "step_peak_mb": peak_memory(step),
+                }
+            )
+            del G, D, opt_g, opt_d
+    return rows
+
+
+def compare(rows, baseline):
+    """ ratio (current / baseline) of every measurement, for the rows of a previous
+    --bench_json run with the same settings (non-float columns). """
+
+    def settings(row):
+        return tuple((k, v) for k, v in row.items() if not isinstance(v, float))
+
+    previous = {settings(row): row for row in baseline["rows"]}
+    ratios = []
+    for row in rows:
+        base = previous.get(settings(row))
+        if base is None:
+            continue
+        ratio = dict(settings(row))
+        for k, v in row.items():
+            if isinstance(v, float) and base.get(k):
+                ratio[k] = v / base[k]
+        ratios.append(ratio)
+    return ratios
+
+
+@register("noise")
+def bench_noise(args):
+    """ add_noise on a batch of images and generalized dropout (prop mode) on D's
+    newest activations: previous numpy draws copied to the device vs. draws from
+    a torch.Generator on the device. time, host memory allocated (numpy and torch)
+    and whether two generators with the same seed draw the same noise. """
+    import tracemalloc
+    import custom_layers as cl
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def host_allocated(func):
+        tracemalloc.start()
+        func()
+        numpy_mb = tracemalloc.get_traced_memory()[1] / pow(2, 20)
+        tracemalloc.stop()
+        return numpy_mb + allocated_memory(func)
+
+    def old_add_noise(x):
+        z = np.random.randn(*x.size()).astype(np.float32) * 0.1
+        return x + torch.from_numpy(z).to(x.device)
+
+    def new_add_noise(x, gen):
+        return x + torch.randn(x.size(), generator=gen, device=x.device) * 0.1
+
+    def old_gdrop(layer, x):
+        rnd_shape = [s if a in layer.axes else 1 for a, s in enumerate(x.size())]
+        rnd = np.random.normal(size=rnd_shape) * layer.strength * x.size(1) ** 0.5 + 1
+        return x * torch.from_numpy(rnd).type(x.dtype).to(x.device)
+
+    rows = []
+    for resl in range(2, args.max_resl + 1):
+        size = pow(2, resl)
+        gdrop = cl.generalized_drop_out(mode="prop", strength=0.2)
+        cases = [
+            (
+                "add_noise",
+                torch.randn(args.batchsize, 3, size, size, device=device),
+                old_add_noise,
+                new_add_noise,
+            ),
+            (
+                "gdrop",
+                torch.randn(args.batchsize, min(config.ndf, 512), size, size).to(
+                    device
+                ),
+                lambda x: old_gdrop(gdrop, x),
+                lambda x, gen: cl.set_generator(gdrop, gen) or gdrop(x),
+            ),
+        ]
+        for name, x, old, new in cases:
+            gen = torch.Generator(device=device).manual_seed(0)
+            same = torch.equal(
+                new(x, torch.Generator(device=device).manual_seed(1)),
+                new(x, torch.Generator(device=device).manual_seed(1)),
+            )
+            t_old = timeit(lambda: old(x), args.n_iter)
+            t_new = timeit(lambda: new(x, gen), args.n_iter)
+            rows.append(
+                {
+                    "resl": size,
+                    "op": name,
+                    "old_ms": t_old * 1000,
+                    "new_ms": t_new * 1000,
+                    "speedup": t_old / t_new,
+                    "old_host_mb": host_allocated(lambda: old(x)),
+                    "new_host_mb": host_allocated(lambda: new(x, gen)),
+                    "reproducible": same,
+                }
+            )
+    return rows
+
+
+@register("fused_d")
+def bench_fused_d(args):
+    """ D over reals and fakes in two passes vs. one concatenated pass (minibatch-std
+    per half): loss and gradient differences, and training step time (checks.py
+    fused_d asserts that they match). """
+    from torch.optim import SGD
+
+    cfg = bench_config(args.small_dim)
+    rows = []
+    for resl in range(2, args.max_resl + 1):
+        for fadein in [True, False] if resl > 2 else [False]:
+            torch.manual_seed(0)
+            G, D = build_networks(cfg, resl, fadein=fadein)
+            x = synthetic_images(args.batchsize, resl)
+            z = torch.randn(args.batchsize, cfg.nz)
+            results = []
+            for fused in [False, True]:
+                g, d = copy.deepcopy(G), copy.deepcopy(D)
+                # lr=0: the weights do not move, so every step gets the same losses.
+                opt_g, opt_d = SGD(g.parameters(), lr=0.0), SGD(d.parameters(), lr=0.0)
+
+                def step():
+                    return train_step(g, d, opt_g, opt_d, x, z, fused_d=fused)
+
+                losses = step()
+                grads = torch.cat(
+                    [p.grad.view(-1) for p in g.parameters()]
+                    + [p.grad.view(-1) for p in d.parameters()]
+                )
+                results.append((losses, grads, timeit(step, args.n_iter)))
+            (losses, grads, t), (f_losses, f_grads, f_t) = results
+            rows.append(
+                {
+                    "resl": pow(2, resl),
+                    "state": "fadein" if fadein else "flushed",
+                    "loss_d_diff": abs(losses[0] - f_losses[0]),
+                    "loss_g_diff": abs(losses[1] - f_losses[1]),
+                    "grad_rel_diff": ((grads - f_grads).norm() / grads.norm()).item(),
+                    "two_pass_ms": t * 1000,
+                    "fused_ms": f_t * 1000,
+                    "speedup": t / f_t,
+                }
+            )
+    return rows
+
+
+@register("lazy_reg")
+def bench_lazy_reg(args):
+    """ gradient penalty every step vs. every k steps (weighted by k), and on half
+    of the reals: steps/sec and peak memory over k steps at 4x4 .. --max_resl, and
+    the losses of a fixed evaluation batch while training --n_steps at 8x8. """
+    from torch.optim import Adam
+    from regularization import lazy_regularizer
+
+    cfg = bench_config(args.small_dim)
+    settings = [(1, 1.0), (4, 1.0), (4, 0.5), (16, 1.0)]
+    mse = torch.nn.MSELoss()
+
+    def make_step(G, D, opt_g, opt_d, every, fraction):
+        reg = lazy_regularizer(
+            bench_config(reg_every=every, reg_batch_fraction=fraction)
+        )
+
+        def step(x, z):
+            weight = reg.step(x.size(-1))
+            return train_step(
+                G,
+                D,
+                opt_g,
+                opt_d,
+                x,
+                z,
+                reg_weight=weight,
+                reg_batch=reg.sub_batch(x.size(0)),
+            )
+
+        return step
+
+    rows = []
+    for resl in range(2, args.max_resl + 1):
+        torch.manual_seed(0)
+        G, D = build_networks(cfg, resl)
+        x = synthetic_images(args.batchsize, resl)
+        z = torch.randn(args.batchsize, cfg.nz)
+        for every, fraction in settings:
+            g, d = copy.deepcopy(G), copy.deepcopy(D)
+            step = make_step(
+                g, d, Adam(g.parameters()), Adam(d.parameters()), every, fraction
+            )
+
+            def k_steps():
+                for _ in range(every):
+                    step(x, z)
+
+            t = timeit(k_steps, max(1, args.n_iter // every)) / every
+            rows.append(
+                {
+                    "resl": pow(2, resl),
+                    "reg_every": every,
+                    "reg_fraction": fraction,
+                    "steps_per_sec": 1.0 / t,
+                    "peak_mb": peak_memory(k_steps),
+                }
+            )
+
+    # loss curves: same data, latents and initial weights for every setting.
+    torch.manual_seed(0)
+    G, D = build_networks(cfg, 3)
+    data = synthetic_images(args.n_images, 3)
+    z_eval = torch.randn(64, cfg.nz, generator=torch.Generator().manual_seed(9))
+    x_eval = data[:64]
+    curves = {}
+    for every, fraction in settings:
+        g, d = copy.deepcopy(G), copy.deepcopy(D)
+        betas = (cfg.beta1, cfg.beta2)
+        opt_g = Adam(g.parameters(), lr=cfg.lr, betas=betas)
+        opt_d = Adam(d.parameters(), lr=cfg.lr, betas=betas)
+        step = make_step(g, d, opt_g, opt_d, every, fraction)
+        gen = torch.Generator().manual_seed(1)
+        curve = []
+        for i in range(args.n_steps):
+            idx = torch.randint(0, args.n_images, (args.batchsize,), generator=gen)
+            step(data[idx], torch.randn(args.batchsize, cfg.nz, generator=gen))
+            if (i + 1) % args.window == 0:
+                with torch.no_grad():
+                    fx, fx_tilde = d(x_eval).squeeze(), d(g(z_eval)).squeeze()
+                curve.append(
+                    (
+                        (
+                            mse(fx, torch.ones_like(fx)) + mse(fx_tilde, 0 * fx_tilde)
+                        ).item(),
+                        mse(fx_tilde, torch.ones_like(fx_tilde)).item(),
+                    )
+                )
+        curves[(every, fraction)] = np.array(curve)
+    baseline = curves[settings[0]]
+    for every, fraction in settings:
+        curve = curves[(every, fraction)]
+        rows.append(
+            {
+                "resl": 8,
+                "reg_every": every,
+                "reg_fraction": fraction,
+                "final_eval_loss_d": float(curve[-1, 0]),
+                "final_eval_loss_g": float(curve[-1, 1]),
+                "curve_diff_d": float(np.abs(curve[:, 0] - baseline[:, 0]).mean()),
+                "curve_diff_g": float(np.abs(curve[:, 1] - baseline[:, 1]).mean()),
+            }
+        )
+    return rows
+
+
+@register("serve")
+def bench_serve(args):
+    """ load test of the inference server: --n_iter requests of one sample per
+    client, for 1 .. 16 concurrent clients, without and with request coalescing
+    (p50/p99 latency and images/sec). the server runs in-process on a unix
+    socket, at --max_resl with --small_dim channels; or give the address of a
+    running server (host:port or socket path) with --serve_address. also times
+    loading a checkpoint, and checks that a sample does not depend on its batch. """
+    import threading
+    import inference
+    import network as net
+
+    def load_test(address, n_clients):
+        latencies = [[] for _ in range(n_clients)]
+
+        def client(c):
+            conn = inference.connect(address)
+            for i in range(args.n_iter):
+                start = time.perf_counter()
+                inference.request_samples(conn, 1, c * args.n_iter + i)
+                latencies[c].append(time.perf_counter() - start)
+            conn.close()
+
+        threads = [threading.Thread(target=client, args=(c,)) for c in range(n_clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        ms = 1000.0 * np.array(sum(latencies, []))
+        return {
+            "clients": n_clients,
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "images_per_sec": len(ms) / elapsed,
+        }
+
+    if args.serve_address:
+        return [
+            dict(load_test(args.serve_address, n), server=args.serve_address)
+            for n in [1, 4, 16]
+        ]
+
+    cfg = bench_config(args.small_dim)
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        torch.manual_seed(0)
+        G, _ = build_networks(cfg, args.max_resl)
+        path = os.path.join(root, "gen.pth.tar")
+        state = {"resl": args.max_resl, "state_dict": G.state_dict()}
+        torch.save(dict(state, scales=net.get_scales(G)), path)
+
+        def replay():
+            model = net.Generator(cfg)
+            for r in range(3, args.max_resl + 1):
+                model.grow_network(r)
+                model.flush_network()
+            model.load_state_dict(torch.load(path)["state_dict"])
+
+        rows.append(
+            {"load": "grow/flush replay", "load_ms": 1000.0 * timeit(replay, 5),}
+        )
+        rows.append(
+            {
+                "load": "build_flushed",
+                "load_ms": 1000.0
+                * timeit(lambda: inference.load_generator(path, cfg), 5),
+            }
+        )
+
+        G, _ = inference.load_generator(path, cfg)
+        for max_batch, latency in [(1, 0.0), (64, 0.005)]:
+            batcher = inference.sample_batcher(G, cfg.nz, max_batch, latency)
+            socket_path = os.path.join(root, "serve.sock")
+            server = inference.make_server(batcher, {}, socket_path=socket_path)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            for n_clients in [1, 4, 16]:
+                batcher.images = batcher.batches = 0
+                row = load_test(socket_path, n_clients)
+                row.update(
+                    max_batch=max_batch,
+                    max_latency_ms=1000.0 * latency,
+                    mean_batch=batcher.stats()["mean_batch"],
+                )
+                rows.append(row)
+            if max_batch > 1:
+                # the same seeds, one per request and in one request.
+                conn = inference.connect(socket_path)
+                alone = [inference.request_samples(conn, 1, s) for s in range(8)]
+                batched = inference.request_samples(conn, 8, 0)
+                conn.close()
+                diff = np.abs(np.concatenate(alone).astype(int) - batched).max()
+                rows.append({"max_diff_batched": int(diff)})
+            server.shutdown()
+            server.server_close()
+            batcher.close()
+    return rows
+
+
+@register("export")
+def bench_export(args):
+    """ torchscript export (export.py) vs. the eager generator, at --max_resl with
+    --small_dim channels: cold start of a new process (imports, loading, first
+    sample; best of 3), and ms per batch of 1 .. 64 samples. """
+    import subprocess
+    import export
+    import inference
+    import network as net
+
+    cfg = bench_config(args.small_dim)
+    cold_start = {
+        "eager": "from config import config\n"
+        "import inference\n"
+        "t1 = time.perf_counter()\n"
+        "G, _ = inference.load_generator(path, config)\n",
+        "torchscript": "import export\n"
+        "t1 = time.perf_counter()\n"
+        "G, _ = export.load_exported(path)\n",
+    }
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        torch.manual_seed(0)
+        G, _ = build_networks(cfg, args.max_resl)
+        path = os.path.join(root, "gen.pth.tar")
+        state = {"resl": args.max_resl, "state_dict": G.state_dict()}
+        torch.save(dict(state, scales=net.get_scales(G)), path)
+        export.export_generator(path, os.path.join(root, "gen.pt"), cfg)
+
+        for name, load in cold_start.items():
+            script = (
+                "import time, json, sys\n"
+                "t0 = time.perf_counter()\n"
+                "import torch\n"
+                "path = sys.argv[1]\n" + load + "t2 = time.perf_counter()\n"
+                "with torch.inference_mode():\n"
+                "    G(torch.randn(1, {}))\n"
+                "t3 = time.perf_counter()\n"
+                "print(json.dumps([t1 - t0, t2 - t1, t3 - t2]))\n"
+            ).format(cfg.nz)
+            target = path if name == "eager" else os.path.join(root, "gen.pt")
+            runs = []
+            for _ in range(3):
+                start = time.perf_counter()
+                out = subprocess.run(
+                    [sys.executable, "-W", "ignore", "-c", script, target]
+                    + ["--ngf", str(cfg.ngf), "--nz", str(cfg.nz)],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stdout=subprocess.PIPE,
+                    check=True,
+                )
+                times = json.loads(out.stdout.decode().strip().splitlines()[-1])
+                runs.append([time.perf_counter() - start] + times)
+            process, imports, load, first = min(runs)
+            rows.append(
+                {
+                    "model": name,
+                    "process_sec": process,
+                    "import_sec": imports,
+                    "load_ms": 1000.0 * load,
+                    "first_batch_ms": 1000.0 * first,
+                }
+            )
+
+        eager, _ = inference.load_generator(path, cfg)
+        scripted, _ = export.load_exported(os.path.join(root, "gen.pt"))
+        for batch in [1, 16, 64]:
+            z = torch.randn(batch, cfg.nz)
+            with torch.inference_mode():
+                t_eager = timeit(lambda: eager(z), args.n_iter)
+                t_script = timeit(lambda: scripted(z), args.n_iter, n_warmup=3)
+                diff = (eager(z) - scripted(z)).abs().max().item()
+            rows.append(
+                {
+                    "batch": batch,
+                    "eager_ms": 1000.0 * t_eager,
+                    "torchscript_ms": 1000.0 * t_script,
+                    "speedup": t_eager / t_script,
+                    "max_abs_diff": diff,
+                }
+            )
+    return rows
+
+
+@register("accumulate")
+def bench_accumulate(args):
+    """ one logical batch as a single pass vs. accumulated over micro-batches (with
+    minibatch-std over groups of one micro-batch in both cases): gradient
+    difference, step time and peak memory. """
+    from torch.optim import SGD
+
+    rows = []
+    n_accum = 4
+    micro = args.batchsize // n_accum
+    cfg = bench_config(args.small_dim, mbstd_group=micro)
+    for resl in range(2, args.max_resl + 1):
+        torch.manual_seed(0)
+        G, D = build_networks(cfg, resl)
+        x = synthetic_images(micro * n_accum, resl)
+        z = torch.randn(micro * n_accum, cfg.nz)
+        grads, times, peaks = [], [], []
+        for k in [1, n_accum]:
+            g, d = copy.deepcopy(G), copy.deepcopy(D)
+            # lr=0: the weights do not move, so every step gets the same gradients.
+            opt_g, opt_d = SGD(g.parameters(), lr=0.0), SGD(d.parameters(), lr=0.0)
+
+            def step():
+                train_step(g, d, opt_g, opt_d, x, z, n_accum=k)
+
+            times.append(timeit(step, args.n_iter))
+            peaks.append(peak_memory(step))
+            grads.append(
+                torch.cat(
+                    [p.grad.view(-1) for p in g.parameters()]
+                    + [p.grad.view(-1) for p in d.parameters()]
+                )
+            )
+        rows.append(
+            {
+                "resl": pow(2, resl),
+                "batch": micro * n_accum,
+                "micro_batch": micro,
+                "single_ms": times[0] * 1000,
+                "accum_ms": times[1] * 1000,
+                "single_peak_mb": peaks[0],
+                "accum_peak_mb": peaks[1],
+                "grad_rel_diff": (
+                    (grads[0] - grads[1]).norm() / grads[0].norm()
+                ).item(),
+            }
+        )
+    return rows
+
+
+@register("autotune")
+def bench_autotune(args):
+    """ micro-batch sizes picked by autotune.batch_tuner under a few memory budgets
+    (up to --batchsize): the peak memory of a real training step at that size,
+    its throughput, and the time spent probing, then reading the cache. """
+    import mixed_precision
+    from autotune import batch_tuner, probe_step
+    from torch.optim import Adam
+
+    rows = []
+    cfg = bench_config(args.small_dim)
+    amp = mixed_precision.precision_policy(cfg.precision, "cpu")
+    for resl in range(2, args.max_resl + 1):
+        G, D = build_networks(cfg, resl, fadein=resl > 2)
+        x, z = synthetic_images(1, resl), torch.randn(1, cfg.nz)
+        probe = peak_memory(lambda: probe_step(G, D, x, z, amp))
+        for budget in [4 * probe, 16 * probe, 0]:
+            with tempfile.TemporaryDirectory() as tmp:
+                tune_cfg = bench_config(
+                    args.small_dim, data_cache=tmp, autotune_budget_mb=budget
+                )
+                tuner = batch_tuner(tune_cfg, amp)
+                start = time.perf_counter()
+                batchsize = tuner.tune(G, D, pow(2, resl), args.batchsize)
+                tune_s = time.perf_counter() - start
+                start = time.perf_counter()
+                batch_tuner(tune_cfg, amp).tune(G, D, pow(2, resl), args.batchsize)
+                cached_s = time.perf_counter() - start
+                budget = list(tuner.cache.values())[0]["budget_mb"]
+            opt_g, opt_d = Adam(G.parameters()), Adam(D.parameters())
+            x = synthetic_images(batchsize, resl)
+            z = torch.randn(batchsize, cfg.nz)
+
+            def step():
+                train_step(G, D, opt_g, opt_d, x, z)
+
+            t = timeit(step, args.n_iter)
+            rows.append(
+                {
+                    "resl": pow(2, resl),
+                    "budget_mb": budget,
+                    "batch": batchsize,
+                    "step_peak_mb": peak_memory(step),
+                    "imgs_per_sec": batchsize / t,
+                    "tune_s": tune_s,
+                    "cached_ms": cached_s * 1000,
+                }
+            )
+    return rows
+
+
+@register("profiler")
+def bench_profiler(args):
+    """ cost of the step profiler's spans, disabled and enabled, next to the cost of
+    one training step (the trainer opens ~15 spans per step). """
+    from profiler import step_profiler
+    from torch.optim import Adam
+
+    cfg = bench_config(args.small_dim)
+    G, D = build_networks(cfg, 2)
+    opt_g, opt_d = Adam(G.parameters()), Adam(D.parameters())
+    x = synthetic_images(args.batchsize, 2)
+    z = torch.randn(args.batchsize, cfg.nz)
+    step_ms = 1000 * timeit(lambda: train_step(G, D, opt_g, opt_d, x, z), args.n_iter)
+
+    rows = []
+    n_spans = 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        for enabled in [False, True]:
+            prof = step_profiler(enabled, out_dir=tmp)
+
+            def spans():
+                for i in range(n_spans):
+                    with prof.span("span"):
+                        pass
+                prof.step(0, "init", 2)
+
+            span_us = 1e6 * timeit(spans, 1) / n_spans
+            rows.append(
+                {
+                    "enabled": enabled,
+                    "span_us": span_us,
+                    "step_ms": step_ms,
+                    "overhead_pct": 100 * 15 * span_us / (1000 * step_ms),
+                }
+            )
+            prof.close()
+    return rows
+
+
+@register("tensorboard")
+def bench_tensorboard(args):
+    """ training steps/sec without tensorboard, with the previous synchronous
+    logging (SummaryWriter calls and a G forward every step), and with the queued
+    tf_recorder at the trainer's default intervals. """
+    import tf_recorder
+    from tensorboardX import SummaryWriter
+    from torch.optim import Adam
+
+    cfg = bench_config(args.small_dim)
+    resl = min(args.max_resl, 4)
+    G, D = build_networks(cfg, resl)
+    Gs = copy.deepcopy(G)
+    opt_g, opt_d = Adam(G.parameters()), Adam(D.parameters())
+    x = synthetic_images(args.batchsize, resl)
+    z = torch.randn(args.batchsize, cfg.nz)
+    z_test = torch.randn(args.batchsize, cfg.nz)
+
+    rows = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for mode in ["off", "sync", "queued"]:
+                if mode == "sync":
+                    writer = SummaryWriter(os.path.join(tmp, "sync"))
+                if mode == "queued":
+                    recorder = tf_recorder.tf_recorder()
+                n_steps = [0]
+
+                def step():
+                    loss_d, loss_g = train_step(G, D, opt_g, opt_d, x, z)
+                    n_steps[0] = n_steps[0] + 1
+                    i = n_steps[0]
+                    if mode == "sync":
+                        with torch.no_grad():
+                            Gs(z_test)
+                        writer.add_scalar("data/loss_g", loss_g, i)
+                        writer.add_scalar("data/loss_d", loss_d, i)
+                        writer.add_scalar("tick/lr", cfg.lr, i)
+                        writer.add_scalar("tick/cur_resl", pow(2, resl), i)
+                    if mode == "queued":
+                        if i % 10 == 0:
+                            recorder.add_scalar("data/loss_g", loss_g, i)
+                            recorder.add_scalar("data/loss_d", loss_d, i)
+                        if i % 5 == 0:
+                            recorder.add_scalar("tick/lr", cfg.lr, i)
+                            recorder.add_scalar("tick/cur_resl", pow(2, resl), i)
+
+                t = timeit(step, args.n_iter)
+                if mode == "sync":
+                    writer.close()
+                if mode == "queued":
+                    recorder.close()
+                if mode == "off":
+                    baseline = t
+                rows.append(
+                    {
+                        "resl": pow(2, resl),
+                        "mode": mode,
+                        "steps_per_sec": 1.0 / t,
+                        "overhead_pct": 100.0 * (t - baseline) / baseline,
+                    }
+                )
+        finally:
+            os.chdir(cwd)
+    return rows
+
+
+def distributed_worker(args, resl, out):
+    """ one rank of bench_distributed: train G and D on its share of the global
+    batch, then compare the parameters of all ranks. """
+    import dist_utils
+    import torch.distributed as dist
+    from torch.optim import Adam
+
+    dist_utils.init("gloo")
+    rank, world_size = dist_utils.get_rank(), dist_utils.get_world_size()
+    torch.set_num_threads(1)
+    cfg = bench_config(args.small_dim)
+    torch.manual_seed(rank)  # different initial weights, fixed by the broadcast.
+    G, D = build_networks(cfg, resl)
+    dist_utils.broadcast_module(G)
+    dist_utils.broadcast_module(D)
+    opt_g = Adam(G.parameters(), lr=cfg.lr, betas=(0.0, 0.99))
+    opt_d = Adam(D.parameters(), lr=cfg.lr, betas=(0.0, 0.99))
+    data = synthetic_images(args.n_images, resl)
+    batchsize = args.batchsize // world_size
+    gen = torch.Generator().manual_seed(rank)
+
+    def step():
+        idx = torch.randint(0, args.n_images, (batchsize,), generator=gen)
+        z = torch.randn(batchsize, cfg.nz, generator=gen)
+        train_step(G, D, opt_g, opt_d, data[idx], z)
+
+    dist_utils.barrier()
+    t = timeit(step, args.n_iter)
+    flat = torch.cat(
+        [p.detach().view(-1) for p in G.parameters()]
+        + [p.detach().view(-1) for p in D.parameters()]
+    )
+    gathered = [flat]
+    if world_size > 1:
+        gathered = [torch.empty_like(flat) for _ in range(world_size)]
+        dist.all_gather(gathered, flat)
+    if rank == 0:
+        row = {
+            "resl": pow(2, resl),
+            "world_size": world_size,
+            "global_batch": batchsize * world_size,
+            "step_ms": t * 1000,
+            "imgs_per_sec": batchsize * world_size / t,
+            "max_param_diff": max((g - flat).abs().max().item() for g in gathered),
+        }
+        with open(out, "w") as f:
+            json.dump(row, f)
+    dist_utils.cleanup()
+
+
+@register("distributed")
+def bench_distributed(args):
+    """ data-parallel training over 1, 2 and 4 local cpu processes (gloo): step time
+    at a fixed global batch, and whether all ranks still hold the same weights. """
+    import dist_utils
+
+    rows = []
+    for resl in [2, 3]:
+        for world_size in [1, 2, 4]:
+            with tempfile.TemporaryDirectory() as tmp:
+                out = os.path.join(tmp, "row.json")
+                dist_utils.launch(distributed_worker, world_size, (args, resl, out))
+                with open(out) as f:
+                    rows.append(json.load(f))
+    return rows
+
+
+def report(name, rows, out=None):
+    print("----------------- benchmark: {} -----------------".format(name))
+    if rows:
+        keys = []  # rows may have different columns.
+        for row in rows:
+            keys = keys + [k for k in row if k not in keys]
+        print(" | ".join("{:>14}".format(k[:14]) for k in keys))
+        for row in rows:
+            print(
+                " | ".join(
+                    "{:>14.4f}".format(v)
+                    if isinstance(v, float)
+                    else "{:>14}".format(str(v))
+                    for v in (row.get(k, "") for k in keys)
+                )
+            )
+    if out:
+        result = {
+            "benchmark": name,
+            "time": time.time(),
+            "torch": torch.__version__,
+            "rows": rows,
+        }
+        with open(out, "w") as f:
+            json.dump(result, f, indent=2)
+        print("[*] results written to {}".format(out))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("PGGAN benchmark")
+    parser.add_argument("name", choices=sorted(benchmarks.keys()))
+    parser.add_argument("--bench_json", type=str, default="")  # write results as json.
+    parser.add_argument(
+        "--bench_baseline", type=str, default=""
+    )  # json of a previous run, to print current / baseline ratios.
+    parser.add_argument("--n_iter", type=int, default=20)  # timed iterations.
+    parser.add_argument("--n_images", type=int, default=256)  # synthetic dataset size.
+    parser.add_argument("--num_workers", type=int, default=2)  # dataloader workers.
+    parser.add_argument("--n_steps", type=int, default=400)  # training steps.
+    parser.add_argument("--window", type=int, default=50)  # steps averaged for losses.
+    parser.add_argument("--batchsize", type=int, default=16)  # synthetic batch size.
+    parser.add_argument("--small_dim", type=int, default=32)  # ngf/ndf/nz of toy runs.
+    parser.add_argument(
+        "--serve_address", type=str, default=""
+    )  # serve: load test a running inference server (host:port or socket path).
+    args, _ = parser.parse_known_args()
+    args.max_resl = config.max_resl
+
+    torch.manual_seed(0)
+    rows = benchmarks[args.name](args)
+    report(args.name, rows, args.bench_json)
+    if args.bench_baseline:
+        with open(args.bench_baseline) as f:
+            report(args.name + " / baseline", compare(rows, json.load(f)))
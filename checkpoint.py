@@ -0,0 +1,141 @@
+""" checkpoint.py
+background checkpoint writer: the training thread hands over a host copy of
+the state, a worker thread serializes it to a temporary file and renames it
+atomically, records it in a small json manifest (so that resuming does not
+need to parse directory listings), then prunes old snapshots according to
+the retention policy.
+"""
+import os
+import json
+import copy
+import queue
+import threading
+import traceback
+
+import torch
+
+
+def to_cpu(obj):
+    """ copy of a (nested) state where every tensor lives in host memory. """
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        return obj.cpu() if obj.device.type != "cpu" else obj.clone()
+    if isinstance(obj, dict):
+        return obj.__class__((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def load_manifest(path):
+    """ list of snapshot entries in path, oldest first ([] if there is no manifest). """
+    manifest_path = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, "r") as f:
+        return json.load(f)["snapshots"]
+
+
+def load(path, mmap=False):
+    """ torch.load on host memory. with mmap=True, tensor storages are mapped
+    from the file lazily instead of being read upfront. """
+    kwargs = {"map_location": "cpu", "weights_only": False}
+    if mmap:
+        kwargs["mmap"] = True
+    try:
+        return torch.load(path, **kwargs)
+    except TypeError:  # older pytorch, without mmap/weights_only.
+        return torch.load(path, map_location="cpu")
+    except RuntimeError as e:
+        # files in the legacy (non-zip) format cannot be mapped: read them.
+        if not mmap or "mmap" not in str(e):
+            raise
+        kwargs.pop("mmap")
+        return torch.load(path, **kwargs)
+
+
+class checkpoint_writer:
+    def __init__(self, path, keep_last=0, keep_per_resl=True):
+        """
+        keep_last: number of most recent snapshots to keep (0: keep everything).
+        keep_per_resl: also keep the latest snapshot of every resolution.
+        """
+        self.path = path
+        self.keep_last = keep_last
+        self.keep_per_resl = keep_per_resl
+        os.makedirs(path, exist_ok=True)
+        self.snapshots = load_manifest(path)
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, info, files):
+        """
+        info: dict with at least resl and tick, recorded in the manifest.
+        files: dict of role (e.g. gen, dis) --> (file name, host state), written
+        together as one snapshot.
+        """
+        self.queue.put((info, files))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            info, files = job
+            try:
+                entry = dict(info, files={})
+                for role, (name, state) in files.items():
+                    self.write(state, os.path.join(self.path, name))
+                    entry["files"][role] = name
+                self.snapshots = [
+                    e for e in self.snapshots if e["tick"] != entry["tick"]
+                ] + [entry]
+                self.prune()
+                self.write_manifest()
+                print(
+                    "[snapshot] model saved @ {} (R{}, T{})".format(
+                        self.path, entry["resl"], entry["tick"]
+                    )
+                )
+            except Exception:
+                traceback.print_exc()
+
+    def write(self, state, path):
+        tmp_path = path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)  # readers never see a partial file.
+
+    def write_manifest(self):
+        manifest_path = os.path.join(self.path, "manifest.json")
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"snapshots": self.snapshots}, f, indent=1)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def prune(self):
+        # only the snapshots recorded in the manifest are managed.
+        if self.keep_last <= 0:
+            return
+        keep = set(
+            range(max(0, len(self.snapshots) - self.keep_last), len(self.snapshots))
+        )
+        if self.keep_per_resl:
+            latest = {}
+            for i, entry in enumerate(self.snapshots):
+                latest[entry["resl"]] = i
+            keep.update(latest.values())
+        kept = []
+        for i, entry in enumerate(self.snapshots):
+            if i in keep:
+                kept.append(entry)
+                continue
+            for name in entry["files"].values():
+                path = os.path.join(self.path, name)
+                if os.path.exists(path):
+                    os.remove(path)
+        self.snapshots = kept
+
+    def close(self):
+        # wait for pending snapshots to be written.
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,228 @@
+""" checks.py
+checks that the optimized code paths compute what the previous (or reference)
+implementation computed, which benchmark.py only times:
+
+  $ python checks.py [name ...]
+
+runs the given checks (all of them by default), and exits with status 1 if one
+of them fails.
+"""
+import copy
+import sys
+import traceback
+from types import SimpleNamespace
+
+import torch
+
+import benchmark
+
+checks = {}
+
+
+def register(name):
+    def wrapper(func):
+        checks[name] = func
+        return func
+
+    return wrapper
+
+
+def devices():
+    return ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+
+@register("dataloader")
+def check_dataloader():
+    """ the persistent stream of dataloader.next_batch only serves full batches,
+    over several epochs of a dataset whose size the batch does not divide (50
+    images, batches of 32), on one process and on each of two ranks. """
+    import tempfile
+    import dataloader as DL
+
+    with tempfile.TemporaryDirectory() as root:
+        cfg = benchmark.bench_config(
+            train_data_root=benchmark.make_synthetic_folder(root, 50, 8),
+            flag_pyramid_cache=False,
+            flag_global_batch=True,
+        )
+        for world_size in [1, 2]:
+            for rank in range(world_size):
+                loader = DL.dataloader(cfg)
+                loader.num_workers = 0
+                loader.rank, loader.world_size = rank, world_size
+                loader.renew(2)
+                expected = 32 // world_size
+                assert loader.batchsize == expected
+                sizes = [loader.next_batch()[0].size(0) for _ in range(5)]
+                assert sizes == [expected] * 5, "rank {} of {}: batches of {}".format(
+                    rank, world_size, sizes
+                )
+                assert loader.epoch == 4, "rank {} of {}: epoch {}".format(
+                    rank, world_size, loader.epoch
+                )
+
+
+@register("interp")
+def check_interp():
+    """ trainer.feed_interpolated_input vs. the per-image PIL path: the PIL path
+    quantized the low resolution copy to 8 bits, so the two may differ by up to
+    (1 - alpha) * 2/255, and the output stays on the device of the input. """
+    from trainer import trainer
+
+    gen = torch.Generator().manual_seed(0)
+    for device in devices():
+        for resl in range(3, 8):
+            imsize = pow(2, resl)
+            x = torch.rand(4, 3, imsize, imsize, generator=gen).mul(2).add(-1)
+            for alpha in [0.0, 0.3, 0.7, 1.0]:
+                state = SimpleNamespace(
+                    use_cuda=device == "cuda",
+                    phase="gtrns",
+                    resl=resl + 0.5,
+                    max_resl=resl,
+                    complete={"gen": alpha * 100},
+                    memory_format=torch.contiguous_format,
+                )
+                x_device = x.to(device)
+                out = trainer.feed_interpolated_input(state, x_device)
+                assert out.device == x_device.device, "{}: output on {}".format(
+                    device, out.device
+                )
+                diff = (out.cpu() - benchmark.pil_interpolated_input(x, alpha)).abs()
+                tolerance = (1 - alpha) * 2.0 / 255 + 1e-6
+                assert (
+                    diff.max().item() <= tolerance
+                ), "{}x{} alpha {} on {}: max abs diff {} > {}".format(
+                    imsize, imsize, alpha, device, diff.max().item(), tolerance
+                )
+
+
+@register("grow")
+def check_grow():
+    """ grow_network / flush_network (blocks spliced by reference) vs. the previous
+    implementation (rebuilt containers, copied weights), from 4x4 to 128x128: same
+    state_dict keys and values, and same outputs, in the fade-in state and
+    flushed. the parameters of existing blocks are reused, not copied. """
+    import network as net
+
+    cfg = benchmark.bench_config(16)
+    nets = {}
+    for name in ["new", "old"]:
+        torch.manual_seed(0)
+        nets[name] = [net.Generator(cfg), net.Discriminator(cfg)]
+
+    def param_ids(nets):
+        return {id(p) for model in nets for p in model.parameters()}
+
+    def compare(stage):
+        z = torch.randn(4, cfg.nz)
+        for new, old in zip(nets["new"], nets["old"]):
+            new_state, old_state = new.state_dict(), old.state_dict()
+            assert list(new_state) == list(old_state), "{}: {} keys differ".format(
+                stage, type(new).__name__
+            )
+            for key in new_state:
+                assert torch.equal(new_state[key], old_state[key]), "{}: {}".format(
+                    stage, key
+                )
+        with torch.no_grad():
+            x = [G(z) for G, _ in nets.values()]
+            fx = [D(x[0]) for _, D in nets.values()]
+        assert torch.equal(x[0], x[1]), "{}: G outputs differ".format(stage)
+        assert torch.equal(fx[0], fx[1]), "{}: D outputs differ".format(stage)
+
+    compare("4x4")
+    for resl in range(3, 8):
+        stage = "{}x{}".format(pow(2, resl), pow(2, resl))
+        before = param_ids(nets["new"])
+        for name, grow in [
+            ("new", lambda model: model.grow_network(resl)),
+            ("old", lambda model: benchmark.old_grow_network(model, resl)),
+        ]:
+            torch.manual_seed(resl)  # same initialization of the new blocks.
+            for model in nets[name]:
+                grow(model)
+                model.model.fadein_block.update_alpha(0.4)
+        grown = param_ids(nets["new"])
+        assert before <= grown, "{}: grow_network replaced parameters".format(stage)
+        compare(stage + " fade-in")
+
+        for model in nets["new"]:
+            model.flush_network()
+        for model in nets["old"]:
+            benchmark.old_flush_network(model)
+        flushed = param_ids(nets["new"])
+        assert flushed <= grown, "{}: flush_network replaced parameters".format(stage)
+        compare(stage + " flushed")
+
+
+@register("fused_d")
+def check_fused_d():
+    """ --flag_fused_d: one D pass over reals and fakes (minibatch-std per half) vs.
+    two passes, through the D and G steps of trainer.train (trainer.d_step_loss,
+    trainer.g_step_loss), from 4x4 to 32x32 in the fade-in state (alpha 0.4) and
+    flushed, with the gradient penalty on all the reals or on half of them: same
+    D and G losses, and same gradients of G and D, within float32 rounding. """
+    from torch.optim import SGD
+
+    cfg = benchmark.bench_config(16)
+    settings = [
+        (resl, fadein, reg_batch)
+        for resl in range(2, 6)
+        for fadein in ([True, False] if resl > 2 else [False])
+        for reg_batch in [None, 4]
+    ]
+    for resl, fadein, reg_batch in settings:
+        stage = "{}x{} {}, penalty on {} reals".format(
+            pow(2, resl),
+            pow(2, resl),
+            "fade-in" if fadein else "flushed",
+            reg_batch or "all",
+        )
+        torch.manual_seed(0)
+        G, D = benchmark.build_networks(cfg, resl, fadein=fadein)
+        if fadein:
+            G.model.fadein_block.update_alpha(0.4)
+            D.model.fadein_block.update_alpha(0.4)
+        x = benchmark.synthetic_images(8, resl)
+        z = torch.randn(8, cfg.nz)
+        results = []
+        for fused in [False, True]:
+            g, d = copy.deepcopy(G), copy.deepcopy(D)
+            # lr=0: both steps see the same weights.
+            opt_g, opt_d = SGD(g.parameters(), lr=0.0), SGD(d.parameters(), lr=0.0)
+            torch.manual_seed(1)
+            losses = benchmark.train_step(
+                g, d, opt_g, opt_d, x, z, fused_d=fused, reg_batch=reg_batch
+            )
+            grads = [
+                torch.cat([p.grad.view(-1) for p in model.parameters()])
+                for model in [g, d]
+            ]
+            results.append((losses, grads))
+        (losses, grads), (f_losses, f_grads) = results
+        for name, loss, f_loss in zip(["D", "G"], losses, f_losses):
+            assert abs(loss - f_loss) <= 1e-5 * max(
+                1.0, abs(loss)
+            ), "{}: {} loss {} (two passes) vs. {} (fused)".format(
+                stage, name, loss, f_loss
+            )
+        for name, grad, f_grad in zip(["G", "D"], grads, f_grads):
+            rel_diff = ((grad - f_grad).norm() / grad.norm()).item()
+            assert rel_diff <= 1e-4, "{}: {} gradients differ by {}".format(
+                stage, name, rel_diff
+            )
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(checks.keys())
+    failed = []
+    for name in names:
+        try:
+            checks[name]()
+            print("[ok] {}".format(name))
+        except Exception:
+            traceback.print_exc()
+            print("[FAILED] {}".format(name))
+            failed.append(name)
+    sys.exit(1 if failed else 0)
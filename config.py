@@ -10,7 +10,24 @@ parser.add_argument(
     "--train_data_root", type=str, default="/home/veesion/nabirds/images/"
 )
 parser.add_argument("--random_seed", type=int, default=int(time.time()))
-parser.add_argument("--n_gpu", type=int, default=1)  # for Multi-GPU training.
+parser.add_argument(
+    "--n_gpu", type=int, default=1
+)  # number of training processes (one per gpu, or cpu processes without gpu).
+parser.add_argument(
+    "--dist_backend", type=str, default="gloo"
+)  # torch.distributed backend for multi-process training (gloo | nccl).
+parser.add_argument(
+    "--flag_global_batch", type=bool, default=True
+)  # batch_table sizes are global (split over the processes) rather than per process.
+parser.add_argument(
+    "--flag_pyramid_cache", type=bool, default=False
+)  # decode images once into a multi-resolution cache, and train from it.
+parser.add_argument(
+    "--data_cache", type=str, default="repo/cache"
+)  # where preprocessed data is stored.
+parser.add_argument(
+    "--flag_uint8_data", type=bool, default=True
+)  # load images as uint8, and convert them to float on the training device.
 
 ## training parameters.
 parser.add_argument("--lr", type=float, default=0.001)  # learning rate.
@@ -38,6 +55,24 @@ parser.add_argument("--max_resl", type=int, default=8)  # 10-->1024, 9-->512, 8-
 parser.add_argument("--trns_tick", type=int, default=200)  # transition tick
 parser.add_argument("--stab_tick", type=int, default=500)  # stabilization tick
 parser.add_argument("--resume", type=int, default=0)  # stabilization tick
+parser.add_argument(
+    "--flag_mmap_load", type=bool, default=False
+)  # memory-map checkpoint weights when resuming, instead of reading them upfront.
+parser.add_argument(
+    "--precision", type=str, default="fp32"
+)  # fp32 | bf16 | fp16 (autocast, with loss scaling for fp16).
+parser.add_argument(
+    "--flag_channels_last", type=bool, default=False
+)  # keep G, D and the images in channels-last memory layout.
+parser.add_argument(
+    "--flag_autotune", type=bool, default=False
+)  # measure the micro-batch size of every resolution instead of micro_batch_table.
+parser.add_argument(
+    "--autotune_budget_mb", type=float, default=0
+)  # memory a training step may allocate (0: autotune_mem_fraction of the free memory).
+parser.add_argument(
+    "--autotune_mem_fraction", type=float, default=0.8
+)  # fraction of the free device (or host) memory used when there is no budget.
 
 
 ## network structure.
@@ -69,12 +104,27 @@ parser.add_argument(
     "--flag_norm_latent", type=bool, default=False
 )  # pixelwise normalization of latent vector (z)
 parser.add_argument("--flag_add_drift", type=bool, default=True)  # add drift loss
+parser.add_argument(
+    "--mbstd_group", type=int, default=0
+)  # minibatch-std over groups of this many samples (0: the whole micro-batch).
+parser.add_argument(
+    "--flag_fused_d", type=bool, default=False
+)  # run D once over reals and fakes (minibatch-std still per half).
 
 
 ## optimizer setting.
 parser.add_argument("--optimizer", type=str, default="adam")  # optimizer type.
 parser.add_argument("--beta1", type=float, default=0.0)  # beta1 for adam.
 parser.add_argument("--beta2", type=float, default=0.99)  # beta2 for adam.
+parser.add_argument(
+    "--flag_carry_optim", type=bool, default=True
+)  # keep optimizer state of existing blocks when the network grows.
+parser.add_argument(
+    "--reg_every", type=int, default=1
+)  # gradient penalty (and drift) every k D steps, weighted by k (lazy regularization).
+parser.add_argument(
+    "--reg_batch_fraction", type=float, default=1.0
+)  # fraction of the reals the gradient penalty is computed on.
 
 
 ## display and save setting.
@@ -86,7 +136,31 @@ parser.add_argument(
 )  # save images every specified iteration.
 parser.add_argument(
     "--display_tb_every", type=int, default=5
-)  # display progress every specified iteration.
+)  # record progress scalars on tensorboard every specified iteration.
+parser.add_argument(
+    "--tb_image_every", type=int, default=0
+)  # record image grids on tensorboard every specified iteration (0: never).
+parser.add_argument(
+    "--tb_histogram_every", type=int, default=0
+)  # record weight histograms on tensorboard every specified iteration (0: never).
+parser.add_argument(
+    "--log_every", type=int, default=10
+)  # print (and record) the mean losses every specified iteration.
+parser.add_argument(
+    "--keep_last", type=int, default=0
+)  # number of recent snapshots kept in repo/model (0: keep all).
+parser.add_argument(
+    "--keep_per_resl", type=bool, default=True
+)  # always keep the latest snapshot of every resolution.
+parser.add_argument(
+    "--flag_profile", type=bool, default=False
+)  # time the stages of every step, per tick and per phase (in repo/profile).
+parser.add_argument(
+    "--profile_trace_resl", type=int, default=0
+)  # take a torch.profiler trace at this resolution (log2, 0: no trace).
+parser.add_argument(
+    "--profile_trace_steps", type=int, default=10
+)  # number of steps in the torch.profiler trace.
 
 
 ## parse and save config.
@@ -10,6 +10,7 @@ import torchvision.transforms as transforms
 from torch.autograd import Variable
 from PIL import Image
 import copy
+import contextlib
 from torch.nn.init import kaiming_normal, calculate_gain
 
 # same function as ConcatTable container in Torch7.
@@ -48,9 +49,15 @@ class fadein_layer(nn.Module):
 
 # https://github.com/github-pengge/PyTorch-progressive_growing_of_gans/blob/master/models/base_model.py
 class minibatch_std_concat_layer(nn.Module):
-    def __init__(self, averaging="all"):
+    def __init__(self, averaging="all", group_size=0):
         super(minibatch_std_concat_layer, self).__init__()
         self.averaging = averaging.lower()
+        # group_size > 0: ("all" averaging) statistics over groups of that many
+        # samples instead of the whole (micro-)batch.
+        self.group_size = group_size
+        # n_splits > 1: the batch is made of that many independent batches (e.g.
+        # reals and fakes in one pass), with statistics of their own.
+        self.n_splits = 1
         if "group" in self.averaging:
             self.n = int(self.averaging[5:])
         else:
@@ -63,6 +70,8 @@ class minibatch_std_concat_layer(nn.Module):
 
     def forward(self, x):
         shape = list(x.size())
+        if self.averaging == "all" and (self.group_size or self.n_splits > 1):
+            return self.grouped_forward(x)
         target_shape = copy.deepcopy(shape)
         vals = self.adjusted_std(x, dim=0, keepdim=True)
         if self.averaging == "all":
@@ -92,8 +101,23 @@ class minibatch_std_concat_layer(nn.Module):
         vals = vals.expand(*target_shape)
         return torch.cat([x, vals], 1)
 
+    def grouped_forward(self, x):
+        # groups of consecutive samples: a batch split into micro-batches of
+        # group_size gets the same statistics as the whole batch.
+        n, c, h, w = x.size()
+        split = n // self.n_splits
+        g = min(self.group_size or split, split)
+        if split % g != 0:
+            g = split
+        vals = self.adjusted_std(x.view(-1, g, c, h, w), dim=1, keepdim=True)
+        vals = torch.mean(vals, dim=2)  # [n / g, 1, h, w], like "all" averaging.
+        return torch.cat([x, vals.repeat_interleave(g, dim=0)], 1)
+
     def __repr__(self):
-        return self.__class__.__name__ + "(averaging = %s)" % (self.averaging)
+        return self.__class__.__name__ + "(averaging = %s, group_size = %s)" % (
+            self.averaging,
+            self.group_size,
+        )
 
 
 class pixelwise_norm_layer(nn.Module):
@@ -106,6 +130,14 @@ class pixelwise_norm_layer(nn.Module):
 
 
 # for equaliaeed-learning rate.
+def apply_scale(x, weight, scale):
+    """ multiply either the input or the weight by the runtime scale, whichever is
+    smaller (the weight, except for the wide low resolution layers). """
+    if x.numel() < weight.numel():
+        return x * scale, weight
+    return x, weight * scale
+
+
 class equalized_conv2d(nn.Module):
     def __init__(
         self, c_in, c_out, k_size, stride, pad, initializer="kaiming", bias=False
@@ -119,12 +151,31 @@ class equalized_conv2d(nn.Module):
 
         conv_w = self.conv.weight.data.clone()
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = ((torch.mean(self.conv.weight.data ** 2)) ** 0.5).cpu()
-        self.conv.weight.data.copy_(self.conv.weight.data / self.scale)
+        scale = (torch.mean(self.conv.weight.data ** 2)) ** 0.5
+        self.conv.weight.data.copy_(self.conv.weight.data / scale)
+        # not persistent: the state_dict keys stay the same as before.
+        self.register_buffer("scale", scale, persistent=False)
 
     def forward(self, x):
-        x = self.conv(x.mul(self.scale))
-        return x + self.bias.view(1, -1, 1, 1).expand_as(x)
+        # the bias is added by the convolution itself.
+        x, weight = apply_scale(x, self.conv.weight, self.scale)
+        return F.conv2d(
+            x,
+            weight,
+            self.bias,
+            self.conv.stride,
+            self.conv.padding,
+            self.conv.dilation,
+            self.conv.groups,
+        )
+
+    def folded(self):
+        """ plain nn.Conv2d computing the same, with the scale in its weight. """
+        conv = copy.deepcopy(self.conv)
+        with torch.no_grad():
+            conv.weight.mul_(self.scale)
+        conv.bias = nn.Parameter(self.bias.detach().clone())
+        return conv
 
 
 class equalized_deconv2d(nn.Module):
@@ -138,12 +189,29 @@ class equalized_deconv2d(nn.Module):
 
         deconv_w = self.deconv.weight.data.clone()
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = ((torch.mean(self.deconv.weight.data ** 2)) ** 0.5).cpu()
-        self.deconv.weight.data.copy_(self.deconv.weight.data / self.scale)
+        scale = (torch.mean(self.deconv.weight.data ** 2)) ** 0.5
+        self.deconv.weight.data.copy_(self.deconv.weight.data / scale)
+        self.register_buffer("scale", scale, persistent=False)
 
     def forward(self, x):
-        x = self.deconv(x.mul(self.scale))
-        return x + self.bias.view(1, -1, 1, 1).expand_as(x)
+        x, weight = apply_scale(x, self.deconv.weight, self.scale)
+        return F.conv_transpose2d(
+            x,
+            weight,
+            self.bias,
+            self.deconv.stride,
+            self.deconv.padding,
+            self.deconv.output_padding,
+            self.deconv.groups,
+            self.deconv.dilation,
+        )
+
+    def folded(self):
+        deconv = copy.deepcopy(self.deconv)
+        with torch.no_grad():
+            deconv.weight.mul_(self.scale)
+        deconv.bias = nn.Parameter(self.bias.detach().clone())
+        return deconv
 
 
 class equalized_linear(nn.Module):
@@ -157,12 +225,20 @@ class equalized_linear(nn.Module):
 
         linear_w = self.linear.weight.data.clone()
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = ((torch.mean(self.linear.weight.data ** 2)) ** 0.5).cpu()
-        self.linear.weight.data.copy_(self.linear.weight.data / self.scale)
+        scale = (torch.mean(self.linear.weight.data ** 2)) ** 0.5
+        self.linear.weight.data.copy_(self.linear.weight.data / scale)
+        self.register_buffer("scale", scale, persistent=False)
 
     def forward(self, x):
-        x = self.linear(x.mul(self.scale))
-        return x + self.bias.view(1, -1).expand_as(x)
+        x, weight = apply_scale(x, self.linear.weight, self.scale)
+        return F.linear(x, weight, self.bias)
+
+    def folded(self):
+        linear = copy.deepcopy(self.linear)
+        with torch.no_grad():
+            linear.weight.mul_(self.scale)
+        linear.bias = nn.Parameter(self.bias.detach().clone())
+        return linear
 
 
 # ref: https://github.com/github-pengge/PyTorch-progressive_growing_of_gans/blob/master/models/base_model.py
@@ -175,6 +251,7 @@ class generalized_drop_out(nn.Module):
         self.axes = [axes] if isinstance(axes, int) else list(axes)
         self.normalize = normalize
         self.gain = None
+        self.generator = None  # torch.Generator on the device of the inputs.
 
     def forward(self, x, deterministic=False):
         if deterministic or not self.strength:
@@ -183,20 +260,22 @@ class generalized_drop_out(nn.Module):
         rnd_shape = [
             s if axis in self.axes else 1 for axis, s in enumerate(x.size())
         ]  # [x.size(axis) for axis in self.axes]
+        # drawn on x's device, without a host array and copy.
+        opts = dict(dtype=x.dtype, device=x.device)
         if self.mode == "drop":
             p = 1 - self.strength
-            rnd = np.random.binomial(1, p=p, size=rnd_shape) / p
+            rnd = torch.full(rnd_shape, p, **opts)
+            rnd = torch.bernoulli(rnd, generator=self.generator) / p
         elif self.mode == "mul":
-            rnd = (1 + self.strength) ** np.random.normal(size=rnd_shape)
+            rnd = (1 + self.strength) ** torch.randn(
+                rnd_shape, generator=self.generator, **opts
+            )
         else:
             coef = self.strength * x.size(1) ** 0.5
-            rnd = np.random.normal(size=rnd_shape) * coef + 1
+            rnd = torch.randn(rnd_shape, generator=self.generator, **opts) * coef + 1
 
         if self.normalize:
-            rnd = rnd / np.linalg.norm(rnd, keepdims=True)
-        rnd = Variable(torch.from_numpy(rnd).type(x.data.type()))
-        if x.is_cuda:
-            rnd = rnd.cuda()
+            rnd = rnd / rnd.norm()
         return x * rnd
 
     def __repr__(self):
@@ -207,3 +286,24 @@ class generalized_drop_out(nn.Module):
             self.normalize,
         )
         return self.__class__.__name__ + param_str
+
+
+@contextlib.contextmanager
+def split_batch(model, n_splits):
+    """ within this context, the minibatch-std layers of model treat their input
+    as n_splits batches of equal size. """
+    layers = [m for m in model.modules() if isinstance(m, minibatch_std_concat_layer)]
+    for m in layers:
+        m.n_splits = n_splits
+    try:
+        yield
+    finally:
+        for m in layers:
+            m.n_splits = 1
+
+
+def set_generator(model, generator):
+    """ random draws of the generalized dropout layers of model come from generator. """
+    for m in model.modules():
+        if isinstance(m, generalized_drop_out):
+            m.generator = generator
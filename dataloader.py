@@ -8,16 +8,30 @@ import scipy.misc
 import torchvision
 import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision.datasets import ImageFolder
 from torch.autograd import Variable
 from matplotlib import pyplot as plt
 from PIL import Image
+import pyramid_cache
+import dist_utils
 
 
 class dataloader:
     def __init__(self, config):
         self.root = config.train_data_root
         self.batch_table = {
+            4: 32,
+            8: 32,
+            16: 32,
+            32: 16,
+            64: 16,
+            128: 16,
+            256: 16,
+            512: 12,
+            1024: 8,
+        }  # logical batch size: images per optimizer step.
+        self.micro_batch_table = {
             4: 32,
             8: 32,
             16: 32,
@@ -27,46 +41,163 @@ class dataloader:
             256: 12,
             512: 3,
             1024: 1,
-        }  # change this according to available gpu memory.
-        self.batchsize = int(self.batch_table[pow(2, 2)])  # we start from 2^2=4
+        }  # images per forward/backward pass: change this according to available gpu memory.
+        # when a logical batch does not fit in one micro-batch, the trainer
+        # accumulates the gradients of several micro-batches (e.g. 4 x 3 images
+        # at 512x512, 8 x 1 at 1024x1024).
+        # with several ranks, each one reads a disjoint shard of the dataset, and
+        # the batch_table sizes are either split over the ranks or per rank.
+        self.rank = dist_utils.get_rank()
+        self.world_size = dist_utils.get_world_size()
+        self.flag_global_batch = config.flag_global_batch
+        # workers send uint8 images, converted to float on the training device.
+        self.flag_uint8 = config.flag_uint8_data
+        self.batchsize, self.n_accum = self.micro_batching(pow(2, 2))  # 2^2=4
+        self.global_batchsize = self.batchsize * self.n_accum * self.world_size
         self.imsize = int(pow(2, 2))
-        self.num_workers = 10
+        self.num_workers = max(1, 10 // self.world_size)  # shared by the ranks.
+        self.pyramid = None
+        if config.flag_pyramid_cache:
+            # rank 0 builds the cache, the other ranks wait for it and load it.
+            if dist_utils.is_main():
+                self.pyramid = pyramid_cache.load_or_build(
+                    self.root, config.data_cache, config.max_resl, self.num_workers
+                )
+            dist_utils.barrier()
+            if not dist_utils.is_main():
+                self.pyramid = pyramid_cache.load_or_build(
+                    self.root, config.data_cache, config.max_resl, self.num_workers
+                )
+        self.dataloader = None
+        self.sampler = None
+        self.data_iter = None
+        self.epoch = 0  # number of completed passes over the dataset.
+        self.stack = 0  # number of images served in the current epoch.
+
+    def logical_batchsize(self, imsize):
+        """ images per optimizer step, on this rank. """
+        batchsize = int(self.batch_table[imsize])
+        if self.flag_global_batch:
+            batchsize = max(1, batchsize // self.world_size)
+        return batchsize
+
+    def micro_batching(self, imsize):
+        """ (micro-batch size, number of micro-batches per step) of this rank. the
+        micro-batch is the largest divisor of the logical batch that is not larger
+        than micro_batch_table, so that every step trains the logical batch. """
+        batchsize = self.logical_batchsize(imsize)
+        micro = max(1, min(batchsize, int(self.micro_batch_table[imsize])))
+        while batchsize % micro != 0:
+            micro = micro - 1
+        return micro, batchsize // micro
 
     def renew(self, resl):
-        print(
-            "[*] Renew dataloader configuration, load data from {}.".format(self.root)
-        )
+        batchsize, n_accum = self.micro_batching(pow(2, resl))
+        imsize = int(pow(2, resl))
+        if (
+            self.dataloader is not None
+            and batchsize == self.batchsize
+            and n_accum == self.n_accum
+            and imsize == self.imsize
+        ):
+            return  # nothing changed, keep the running stream (and its workers).
 
-        self.batchsize = int(self.batch_table[pow(2, resl)])
-        self.imsize = int(pow(2, resl))
-        self.dataset = ImageFolder(
-            root=self.root,
-            transform=transforms.Compose(
-                [
-                    transforms.Resize(
-                        size=(self.imsize, self.imsize), interpolation=Image.NEAREST
-                    ),
-                    transforms.ToTensor(),
-                ]
-            ),
-        )
+        if self.rank == 0:
+            print(
+                "[*] Renew dataloader configuration, load data from {}.".format(
+                    self.root
+                )
+            )
+
+        self.batchsize = batchsize
+        self.n_accum = n_accum
+        # images per optimizer step, over all micro-batches and ranks.
+        self.global_batchsize = batchsize * n_accum * self.world_size
+        self.imsize = imsize
+        if self.pyramid is not None:
+            self.dataset = pyramid_cache.pyramid_dataset(
+                self.pyramid, resl, uint8=self.flag_uint8
+            )
+        else:
+            self.dataset = ImageFolder(
+                root=self.root,
+                transform=transforms.Compose(
+                    [
+                        transforms.Resize(
+                            size=(self.imsize, self.imsize),
+                            interpolation=Image.NEAREST,
+                        ),
+                        transforms.PILToTensor()
+                        if self.flag_uint8
+                        else transforms.ToTensor(),
+                    ]
+                ),
+            )
 
+        # every batch is full (the latents and labels of the trainer, the fused D
+        # pass and grouped minibatch-std need it): the images left over at the
+        # end of an epoch are dropped, and shuffled into a later one.
+        if self.world_size > 1:
+            self.sampler = DistributedSampler(
+                self.dataset,
+                num_replicas=self.world_size,
+                rank=self.rank,
+                drop_last=True,
+            )
+            self.sampler.set_epoch(self.epoch)
+        shard = len(self.dataset) // self.world_size
+        if shard < self.batchsize:
+            raise ValueError(
+                "{} images ({} per process) is fewer than a batch of {}.".format(
+                    len(self.dataset), shard, self.batchsize
+                )
+            )
         self.dataloader = DataLoader(
             dataset=self.dataset,
             batch_size=self.batchsize,
-            shuffle=True,
+            shuffle=self.sampler is None,
+            sampler=self.sampler,
             num_workers=self.num_workers,
+            persistent_workers=self.num_workers > 0,
+            pin_memory=torch.cuda.is_available(),  # asynchronous copies to the gpu.
+            drop_last=True,
         )
+        # drop the old iterator so that its workers are shut down.
+        self.data_iter = None
+        self.stack = 0
 
     def __iter__(self):
         return iter(self.dataloader)
 
     def __next__(self):
-        return next(self.dataloader)
+        return self.get_batch()
 
     def __len__(self):
         return len(self.dataloader.dataset)
 
-    def get_batch(self):
-        dataIter = iter(self.dataloader)
-        return next(dataIter)[0].mul(2).add(-1)  # pixel range [-1, 1]
+    def next_batch(self):
+        # keep a single iterator alive across steps, and roll over to a new
+        # shuffled epoch when it is exhausted.
+        if self.data_iter is None:
+            self.data_iter = iter(self.dataloader)
+        try:
+            batch = next(self.data_iter)
+        except StopIteration:
+            self.epoch = self.epoch + 1
+            self.stack = 0
+            if self.sampler is not None:
+                self.sampler.set_epoch(self.epoch)  # new shuffle, same on all ranks.
+            self.data_iter = iter(self.dataloader)
+            batch = next(self.data_iter)
+        self.stack = self.stack + batch[0].size(0)
+        return batch
+
+    def get_batch(self, device=None):
+        """ next batch of images in [-1, 1], on device (if given). """
+        x = self.next_batch()[0]
+        if device is not None:
+            x = x.to(device, non_blocking=True)
+        if x.dtype == torch.uint8:
+            # conversion and rescaling in a single op: -1 + x * 2/255.
+            return torch.add(torch.tensor(-1.0), x, alpha=2.0 / 255)
+        return x.mul(2).add(-1)  # pixel range [-1, 1]
@@ -0,0 +1,122 @@
+""" dist_utils.py
+multi-process data-parallel training with torch.distributed, one process per
+device (or per cpu process with the gloo backend).
+
+every rank holds a full copy of G and D. gradients are averaged with an
+explicit all-reduce after each backward rather than through
+DistributedDataParallel: the gradient penalty differentiates D twice
+(create_graph=True), and the networks change their parameters at every
+growth, neither of which DDP's reducer supports. new blocks are broadcast
+from rank 0, so that all ranks grow into the same weights.
+"""
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def is_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def is_main():
+    # only rank 0 writes snapshots, previews, logs and tensorboard events.
+    return get_rank() == 0
+
+
+def init(backend="gloo"):
+    """ join the process group described by the environment (RANK, WORLD_SIZE,
+    MASTER_ADDR, MASTER_PORT, as set by launch() or torchrun). """
+    if is_initialized() or int(os.environ.get("WORLD_SIZE", "1")) <= 1:
+        return
+    dist.init_process_group(backend=backend, init_method="env://")
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", get_rank())))
+
+
+def cleanup():
+    if is_initialized():
+        dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawned(rank, world_size, port, func, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    os.environ["RANK"] = os.environ["LOCAL_RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    func(*args)
+
+
+def launch(func, world_size, args=()):
+    """ run func(*args) in world_size local processes (func must be picklable). """
+    mp.spawn(
+        spawned,
+        args=(world_size, free_port(), func, args),
+        nprocs=world_size,
+        join=True,
+    )
+
+
+def barrier():
+    if is_initialized():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """ obj as seen by rank src, on every rank. """
+    if not is_initialized():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+
+def broadcast_module(module, src=0):
+    # parameters and buffers (including the equalized learning rate scales)
+    # are overwritten in place, so optimizers keep tracking them.
+    if not is_initialized():
+        return
+    with torch.no_grad():
+        for t in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(t.data, src=src)
+
+
+def all_reduce_grads(params, bucket_mb=25):
+    """ average the gradients of params over all ranks, in flat buckets of about
+    bucket_mb to amortize the per-call latency. """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    grads = [p.grad for p in params if p.requires_grad and p.grad is not None]
+    bucket, size = [], 0
+    for g in grads + [None]:
+        if g is not None:
+            bucket.append(g)
+            size = size + g.numel() * g.element_size()
+            if size < bucket_mb * pow(2, 20):
+                continue
+        if not bucket:
+            continue
+        flat = _flatten_dense_tensors(bucket)
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+        for g, reduced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            g.copy_(reduced)
+        bucket, size = [], 0
@@ -0,0 +1,77 @@
+""" export.py
+exports the generator of a gen_R*_T*.pth.tar checkpoint as one self-contained
+torchscript file: built flushed at the resolution of the checkpoint (without
+the fade-in branch), with the equalized learning rate scales folded into the
+weights, and frozen. loading it only needs torch (not config, network or the
+checkpoint):
+
+    $ python export.py --checkpoint_path repo/model/gen_R8_T55.pth.tar --out gen_R8.pt
+
+    G, meta = export.load_exported("gen_R8.pt")
+    x = G(torch.randn(16, meta["nz"]))
+"""
+import json
+import argparse
+
+import torch
+import torch.nn as nn
+
+
+class exported_generator(nn.Module):
+    def __init__(self, model):
+        super(exported_generator, self).__init__()
+        self.model = model
+
+    def forward(self, z):
+        return self.model(z.view(z.size(0), -1, 1, 1))
+
+
+def fold_scales(module):
+    """ replaces (in place) the equalized learning rate layers of module by the
+    plain layers computing the same. """
+    for name, child in module.named_children():
+        if hasattr(child, "folded"):
+            setattr(module, name, child.folded())
+        else:
+            fold_scales(child)
+    return module
+
+
+def export_generator(path, out, config, smoothed=True):
+    """ writes the torchscript generator of checkpoint path to out, and returns it
+    with its metadata (resolution, nz). """
+    import inference
+
+    G, resl = inference.load_generator(path, config, smoothed)
+    model = exported_generator(fold_scales(G.model)).eval()
+    scripted = torch.jit.freeze(torch.jit.script(model))
+    meta = {"checkpoint": path, "resl": resl, "imsize": pow(2, resl), "nz": G.nz}
+    torch.jit.save(scripted, out, _extra_files={"meta.json": json.dumps(meta)})
+    return scripted, meta
+
+
+def load_exported(path, device="cpu"):
+    """ generator written by export_generator, and its metadata. """
+    extra_files = {"meta.json": ""}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    return model, json.loads(extra_files["meta.json"])
+
+
+if __name__ == "__main__":
+    from config import config
+
+    parser = argparse.ArgumentParser("PGGAN export")
+    parser.add_argument(
+        "--checkpoint_path", type=str, default="repo/model/gen_R8_T55.pth.tar"
+    )
+    parser.add_argument("--out", type=str, default="")  # default: <checkpoint>.pt
+    parser.add_argument("--smoothed", type=bool, default=True)  # averaged weights.
+    args, _ = parser.parse_known_args()
+
+    out = args.out or args.checkpoint_path.replace(".pth.tar", "") + ".pt"
+    _, meta = export_generator(args.checkpoint_path, out, config, args.smoothed)
+    print(
+        "exported {}x{} generator of {} to {} ...".format(
+            meta["imsize"], meta["imsize"], args.checkpoint_path, out
+        )
+    )
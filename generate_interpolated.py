@@ -2,58 +2,98 @@
 
 
 import os, sys
+import time
+import argparse
 import torch
 from config import config
-from torch.autograd import Variable
-import utils as utils
-
-
-use_cuda = True
-checkpoint_path = "repo/model/gen_R8_T55.pth.tar"
-n_intp = 20
-
-# load trained model.
-import network as net
-
-test_model = net.Generator(config)
-if use_cuda:
-    torch.set_default_tensor_type("torch.cuda.FloatTensor")
-    test_model = torch.nn.DataParallel(test_model).cuda(device=0)
-else:
-    torch.set_default_tensor_type("torch.FloatTensor")
-
-for resl in range(3, config.max_resl + 1):
-    test_model.module.grow_network(resl)
-    test_model.module.flush_network()
-print(test_model)
-
-print("load checkpoint form ... {}".format(checkpoint_path))
-checkpoint = torch.load(checkpoint_path)
-test_model.module.load_state_dict(checkpoint["state_dict"])
-
-# create folder.
-for i in range(1000):
-    name = "repo/interpolation/try_{}".format(i)
-    if not os.path.exists(name):
-        os.system("mkdir -p {}".format(name))
-        break
-
-# interpolate between twe noise(z1, z2).
-z_intp = torch.FloatTensor(1, config.nz)
-z1 = torch.FloatTensor(1, config.nz).normal_(0.0, 1.0)
-z2 = torch.FloatTensor(1, config.nz).normal_(0.0, 1.0)
-if use_cuda:
-    z_intp = z_intp.cuda()
-    z1 = z1.cuda()
-    z2 = z2.cuda()
-    test_model = test_model.cuda()
-
-z_intp = Variable(z_intp)
-
-for i in range(1, n_intp + 1):
-    alpha = 1.0 / float(n_intp + 1)
-    z_intp.data = z1.mul_(alpha) + z2.mul_(1.0 - alpha)
-    fake_im = test_model.module(z_intp)
-    fname = os.path.join(name, "_intp{}.jpg".format(i))
-    utils.save_image_single(fake_im.data, fname, imsize=pow(2, config.max_resl))
-    print("saved {}-th interpolated image ...".format(i))
+import inference
+import preview
+
+
+parser = argparse.ArgumentParser("PGGAN interpolation")
+parser.add_argument(
+    "--checkpoint_path", type=str, default="repo/model/gen_R8_T55.pth.tar"
+)
+parser.add_argument("--n_paths", type=int, default=1)  # number of interpolation paths.
+parser.add_argument("--n_frames", type=int, default=20)  # frames per path.
+parser.add_argument("--batch_size", type=int, default=16)  # frames per forward.
+parser.add_argument("--intp_mode", type=str, default="linear")  # linear | slerp
+parser.add_argument("--n_writers", type=int, default=4)  # image writer threads.
+parser.add_argument("--out_dir", type=str, default="repo/interpolation")
+
+
+def lerp(z1, z2, t):
+    return z1 + (z2 - z1) * t
+
+
+def slerp(z1, z2, t):
+    # spherical interpolation, falls back to lerp for (anti-)parallel vectors.
+    n1 = z1 / z1.norm(dim=1, keepdim=True)
+    n2 = z2 / z2.norm(dim=1, keepdim=True)
+    omega = torch.acos((n1 * n2).sum(dim=1, keepdim=True).clamp(-1, 1))
+    so = torch.sin(omega)
+    out = (torch.sin((1.0 - t) * omega) * z1 + torch.sin(t * omega) * z2) / so
+    return torch.where(so.abs() < 1e-6, lerp(z1, z2, t), out)
+
+
+def interpolation_latents(n_paths, n_frames, nz, mode="linear"):
+    """ all the latents as one (n_paths * n_frames, nz) tensor. path p goes from
+    key p to key p + 1, so consecutive paths form one continuous sequence. """
+    keys = torch.FloatTensor(n_paths + 1, nz).normal_(0.0, 1.0)
+    t = torch.arange(n_frames).float().div(n_frames).view(1, n_frames, 1)
+    z1 = keys[:-1].unsqueeze(1).expand(n_paths, n_frames, nz)
+    z2 = keys[1:].unsqueeze(1).expand(n_paths, n_frames, nz)
+    intp = slerp if mode == "slerp" else lerp
+    return intp(
+        z1.reshape(-1, nz),
+        z2.reshape(-1, nz),
+        t.expand(n_paths, n_frames, 1).reshape(-1, 1),
+    )
+
+
+def render(model, z, out_dir, batch_size, writer):
+    with torch.no_grad():
+        for i in range(0, z.size(0), batch_size):
+            fake_im = model(z[i : i + batch_size])
+            for j in range(fake_im.size(0)):
+                fname = os.path.join(out_dir, "_intp{:05d}.jpg".format(i + j + 1))
+                writer.submit(fake_im[j : j + 1], fname, ngrid=1, imsize=None)
+
+
+if __name__ == "__main__":
+    args, _ = parser.parse_known_args()
+    use_cuda = torch.cuda.is_available()
+
+    # load trained model (the smoothed generator when the checkpoint has one),
+    # built at the resolution of the checkpoint.
+    print("load checkpoint form ... {}".format(args.checkpoint_path))
+    test_model, _ = inference.load_generator(args.checkpoint_path, config)
+    print(test_model)
+
+    # create folder.
+    for i in range(1000):
+        name = os.path.join(args.out_dir, "try_{}".format(i))
+        if not os.path.exists(name):
+            os.makedirs(name)
+            break
+
+    # interpolate between random noises (z_p, z_p+1).
+    z_intp = interpolation_latents(
+        args.n_paths, args.n_frames, config.nz, args.intp_mode
+    )
+    if use_cuda:
+        test_model = test_model.cuda()
+        z_intp = z_intp.cuda()
+
+    writer = preview.preview_exporter(
+        max_pending=2 * args.n_writers, n_workers=args.n_writers, block=True
+    )
+    start = time.perf_counter()
+    render(test_model, z_intp, name, args.batch_size, writer)
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print(
+        "saved {} interpolated images in {:.1f}s ({:.1f} frames/min) ...".format(
+            z_intp.size(0), elapsed, 60.0 * z_intp.size(0) / elapsed
+        )
+    )
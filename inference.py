@@ -0,0 +1,417 @@
+""" inference.py
+serves samples of a trained generator. the generator is built flushed at the
+resolution of the checkpoint (no grow/flush replay), frozen, and run on the
+cpu by default. requests (samples from seeds or latents) are queued, and a
+batching thread coalesces the pending ones into a single forward, waiting at
+most max_latency seconds after the oldest of them for others to join. samples
+are returned as png or raw uint8 bytes by a local http api, on a tcp port or a
+unix socket:
+
+    $ python inference.py --checkpoint_path repo/model/gen_R8_T55.pth.tar --port 8000
+    $ curl "localhost:8000/sample?n=4&seed=0" > samples.png
+
+    GET  /sample?n=4&seed=0&format=png  samples from seeds seed .. seed + n - 1.
+    POST /sample?format=raw             body: {"seeds": [...]} or {"latents": [[...]]}
+    GET  /health                        resolution, nz and batching statistics.
+
+png responses are a grid of the samples, raw responses their uint8 NHWC bytes
+(with the shape in the X-Shape header). a seed always gives the same sample,
+up to one level of rounding depending on the batch it is computed in. the
+server also loads generators exported by export.py (.pt files).
+"""
+import io
+import os
+import json
+import math
+import time
+import queue
+import socket
+import argparse
+import threading
+import traceback
+import http.client
+import http.server
+import socketserver
+from concurrent.futures import Future
+from math import floor
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+from PIL import Image
+
+import checkpoint
+import network as net
+
+
+def flushed_state_dict(state_dict, layer_name):
+    """ state of a generator saved in its fade-in state, as the flushed network
+    (keeping the high resolution branch, like flush_network). """
+    state = {}
+    for key, value in state_dict.items():
+        if key.startswith("concat_block.layer1.") or key.startswith("fadein_block."):
+            continue
+        key = key.replace(
+            "concat_block.layer2.high_resl_block.", layer_name + ".high_resl_block.",
+        )
+        key = key.replace(
+            "concat_block.layer2.high_resl_to_rgb.", "to_rgb_block.high_resl_to_rgb."
+        )
+        state[key] = value
+    return state
+
+
+def load_generator(path, config, smoothed=True, device="cpu", mmap=False):
+    """ frozen generator (in eval mode) for a gen_R*_T*.pth.tar checkpoint, and its
+    resolution (log2). smoothed: use the averaged weights when the checkpoint
+    has them. mmap: map the weights from the file instead of reading them. """
+    state = checkpoint.load(path, mmap=mmap)
+    resl = int(floor(state["resl"]))
+    with torch.random.fork_rng():
+        # older checkpoints lack the scales drawn at initialization: draw the
+        # same ones in every process.
+        torch.manual_seed(0)
+        G = net.Generator(config)
+        G.build_flushed(resl)
+    weights = state["state_dict"]
+    if smoothed:
+        weights = state.get("smoothed_state_dict", weights)
+    scales = state.get("scales", {})
+    if any(k.startswith("concat_block.") for k in weights):
+        weights = flushed_state_dict(weights, G.layer_name)
+        scales = flushed_state_dict(scales, G.layer_name)
+    G.load_state_dict(weights)
+    net.load_scales(G, scales)
+    G.eval().requires_grad_(False)
+    return G.to(device), resl
+
+
+def latents_from_seeds(seeds, nz):
+    """ one latent per seed, drawn from its own generator. """
+    return torch.stack(
+        [torch.randn(nz, generator=torch.Generator().manual_seed(s)) for s in seeds]
+    )
+
+
+def to_uint8(x):
+    """ generator outputs in [-1, 1] (the range of the training data) as a host
+    uint8 NHWC tensor. """
+    x = x.detach().float().add(1.0).mul(127.5).round_().clamp_(0, 255)
+    return x.byte().permute(0, 2, 3, 1).contiguous().cpu()
+
+
+def encode_png(images):
+    """ uint8 NHWC images as one png grid, row by row (padded with black). """
+    n, h, w, c = images.shape
+    ncol = int(math.ceil(math.sqrt(n)))
+    nrow = int(math.ceil(n / float(ncol)))
+    grid = np.zeros((nrow * ncol, h, w, c), dtype=np.uint8)
+    grid[:n] = images.numpy()
+    grid = grid.reshape(nrow, ncol, h, w, c).transpose(0, 2, 1, 3, 4)
+    grid = grid.reshape(nrow * h, ncol * w, c)
+    if c == 1:
+        grid = grid[:, :, 0]
+    buf = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(grid)).save(buf, format="png")
+    return buf.getvalue()
+
+
+class sample_batcher:
+    def __init__(self, model, nz, max_batch=64, max_latency=0.005, device="cpu"):
+        """
+        max_batch: largest batch of a single forward.
+        max_latency: time (seconds) a request may wait for others to join its batch.
+        """
+        self.model = model
+        self.nz = nz
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.device = device
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.images = 0
+        self.batches = 0
+        self.forward_time = 0.0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, z):
+        """ latents (n, nz) --> future of their samples (host uint8 NHWC tensor). """
+        future = Future()
+        self.queue.put((time.perf_counter(), z.view(-1, self.nz), future))
+        return future
+
+    def sample(self, z):
+        return self.submit(z).result()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            jobs = [job]
+            n = job[1].size(0)
+            deadline = job[0] + self.max_latency
+            closing = False
+            while n < self.max_batch:
+                # past the deadline, only the requests already pending join.
+                timeout = deadline - time.perf_counter()
+                try:
+                    if timeout > 0:
+                        job = self.queue.get(timeout=timeout)
+                    else:
+                        job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    closing = True
+                    break
+                jobs.append(job)
+                n = n + job[1].size(0)
+            self.forward(jobs)
+            if closing:
+                break
+
+    def forward(self, jobs):
+        start = time.perf_counter()
+        try:
+            z = torch.cat([z for _, z, _ in jobs]).to(self.device)
+            with torch.inference_mode():
+                x = torch.cat([self.model(c) for c in z.split(self.max_batch)])
+            images = to_uint8(x)
+        except Exception as e:
+            traceback.print_exc()
+            for _, _, future in jobs:
+                future.set_exception(e)
+            return
+        with self.lock:
+            self.requests = self.requests + len(jobs)
+            self.images = self.images + images.size(0)
+            self.batches = self.batches + int(math.ceil(z.size(0) / self.max_batch))
+            self.forward_time = self.forward_time + time.perf_counter() - start
+        sizes = [job_z.size(0) for _, job_z, _ in jobs]
+        for (_, _, future), out in zip(jobs, images.split(sizes)):
+            future.set_result(out)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "images": self.images,
+                "batches": self.batches,
+                "mean_batch": self.images / max(1, self.batches),
+                "forward_sec": self.forward_time,
+            }
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class sample_handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, every response has a length.
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/health":
+            info = dict(self.server.info, **self.server.batcher.stats())
+            return self.reply(json.dumps(info).encode(), "application/json")
+        if url.path != "/sample":
+            return self.send_error(404)
+        try:
+            n = int(query.get("n", ["1"])[0])
+            seed = int(query.get("seed", ["0"])[0])
+        except ValueError:
+            return self.send_error(400, "n and seed must be integers")
+        self.sample(seeds=list(range(seed, seed + n)), query=query)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/sample":
+            return self.send_error(404)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.send_error(400, "body must be json")
+        if not isinstance(body, dict):
+            return self.send_error(400, "body must be a json object")
+        self.sample(body.get("seeds"), body.get("latents"), parse_qs(url.query))
+
+    def sample(self, seeds=None, latents=None, query=None):
+        nz = self.server.batcher.nz
+        fmt = (query or {}).get("format", ["png"])[0]
+        if fmt not in ["png", "raw"]:
+            return self.send_error(400, "format must be png or raw")
+        try:
+            n = len(latents if latents is not None else seeds)
+            if not 0 < n <= self.server.max_samples:
+                return self.send_error(
+                    400, "1 to {} samples per request".format(self.server.max_samples)
+                )
+            if latents is not None:
+                z = torch.tensor(latents, dtype=torch.float32).view(-1, nz)
+            else:
+                z = latents_from_seeds([int(s) for s in seeds], nz)
+        except (TypeError, ValueError, RuntimeError):
+            return self.send_error(400, "give seeds, or latents of size {}".format(nz))
+        try:
+            images = self.server.batcher.sample(z)
+        except Exception:
+            return self.send_error(500)
+        if fmt == "png":
+            return self.reply(encode_png(images), "image/png", images.shape)
+        return self.reply(
+            images.numpy().tobytes(), "application/octet-stream", images.shape
+        )
+
+    def reply(self, body, content_type, shape=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if shape is not None:
+            self.send_header("X-Shape", ",".join(str(s) for s in shape))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address.
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class tcp_http_server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # concurrent clients connecting at once.
+
+
+class unix_http_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        os.remove(self.server_address)  # the socket file created by bind.
+
+
+def make_server(
+    batcher,
+    info,
+    host="127.0.0.1",
+    port=0,
+    socket_path="",
+    max_samples=256,
+    verbose=False,
+):
+    """ http server (not started) answering with batcher; on socket_path if given,
+    on host:port otherwise (port 0: any free port, see server.server_address). """
+    if socket_path:
+        server = unix_http_server(socket_path, sample_handler)
+    else:
+        server = tcp_http_server((host, port), sample_handler)
+    server.batcher = batcher
+    server.info = info
+    server.max_samples = max_samples
+    server.verbose = verbose
+    return server
+
+
+class unix_connection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect(address, timeout=60):
+    """ http connection to a server at host:port, or at a unix socket path. """
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        return http.client.HTTPConnection(host, int(port), timeout=timeout)
+    return unix_connection(address, timeout)
+
+
+def request_samples(conn, n=1, seed=0, fmt="raw"):
+    """ samples from seeds seed .. seed + n - 1, as a uint8 NHWC array (raw) or
+    png bytes. """
+    conn.request("GET", "/sample?n={}&seed={}&format={}".format(n, seed, fmt))
+    response = conn.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise RuntimeError("{} {}".format(response.status, response.reason))
+    if fmt == "png":
+        return body
+    shape = [int(s) for s in response.getheader("X-Shape").split(",")]
+    return np.frombuffer(body, dtype=np.uint8).reshape(shape)
+
+
+if __name__ == "__main__":
+    from config import config
+
+    parser = argparse.ArgumentParser("PGGAN inference server")
+    parser.add_argument(
+        "--checkpoint_path", type=str, default="repo/model/gen_R8_T55.pth.tar"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--socket", type=str, default=""
+    )  # unix socket path (instead of a port).
+    parser.add_argument("--max_batch", type=int, default=64)  # samples per forward.
+    parser.add_argument(
+        "--max_latency_ms", type=float, default=5.0
+    )  # wait for requests to join a batch.
+    parser.add_argument("--max_samples", type=int, default=256)  # samples per request.
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--smoothed", type=bool, default=True
+    )  # averaged generator weights.
+    parser.add_argument("--verbose", type=bool, default=False)  # log every request.
+    args, _ = parser.parse_known_args()
+
+    if args.checkpoint_path.endswith(".pt"):
+        # torchscript generator written by export.py.
+        import export
+
+        G, meta = export.load_exported(args.checkpoint_path, args.device)
+        resl, nz = meta["resl"], meta["nz"]
+    else:
+        G, resl = load_generator(
+            args.checkpoint_path,
+            config,
+            args.smoothed,
+            args.device,
+            mmap=config.flag_mmap_load,
+        )
+        nz = config.nz
+    batcher = sample_batcher(
+        G, nz, args.max_batch, args.max_latency_ms / 1000.0, args.device
+    )
+    info = {"checkpoint": args.checkpoint_path, "imsize": pow(2, resl), "nz": nz}
+    server = make_server(
+        batcher, info, args.host, args.port, args.socket, args.max_samples, args.verbose
+    )
+    print(
+        "serving {}x{} samples of {} on {} ...".format(
+            pow(2, resl),
+            pow(2, resl),
+            args.checkpoint_path,
+            args.socket or "{}:{}".format(*server.server_address[:2]),
+        )
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
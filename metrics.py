@@ -0,0 +1,46 @@
+""" metrics.py
+running training statistics kept on the device. calling .item() on a loss
+waits for the device to finish the step; instead, the losses of every step are
+summed into device tensors, and their means are copied to the host in a
+single transfer every few steps (for the log line and tensorboard).
+"""
+from collections import OrderedDict
+
+import torch
+
+
+class metrics_accumulator:
+    def __init__(self):
+        self.sums = OrderedDict()  # name: device tensor.
+        self.counts = OrderedDict()  # name: number of values summed.
+
+    def add(self, **values):
+        """ add scalar tensors (or numbers) without synchronizing. """
+        for name, value in values.items():
+            if torch.is_tensor(value):
+                value = value.detach().float()
+            if name in self.sums:
+                self.sums[name] = self.sums[name] + value
+                self.counts[name] = self.counts[name] + 1
+            else:
+                self.sums[name] = value
+                self.counts[name] = 1
+
+    def __len__(self):
+        return max(self.counts.values()) if self.counts else 0
+
+    def flush(self):
+        """ means since the last flush, as python floats (one device transfer). """
+        if not self.sums:
+            return OrderedDict()
+        sums = [torch.as_tensor(v, dtype=torch.float32) for v in self.sums.values()]
+        device = next((t.device for t in sums if t.device.type != "cpu"), None)
+        if device is not None:
+            sums = [t.to(device) for t in sums]
+        host = torch.stack(sums).cpu().tolist()
+        means = OrderedDict(
+            (name, total / self.counts[name]) for name, total in zip(self.sums, host)
+        )
+        self.sums = OrderedDict()
+        self.counts = OrderedDict()
+        return means
@@ -0,0 +1,73 @@
+""" mixed_precision.py
+opt-in mixed precision for the trainer. the networks and the optimizers stay
+in fp32; forward passes run under autocast, and fp16 losses are scaled with a
+GradScaler so that small gradients do not underflow. modes that the machine
+cannot run fall back to the nearest one that it can (bf16 on cpu, fp32
+without autocast).
+"""
+import contextlib
+
+import torch
+
+
+def resolve_precision(precision, device_type):
+    """ (autocast dtype or None for fp32, whether to scale losses) actually used
+    for the requested precision on device_type. """
+    if precision == "fp32":
+        return None, False
+    assert precision in ["bf16", "fp16"], "Invalid precision %s" % precision
+    if not hasattr(torch, "autocast"):
+        print("[!] autocast is not available in this pytorch, fall back to fp32.")
+        return None, False
+    if device_type == "cpu":
+        if precision == "fp16":
+            print("[!] fp16 autocast needs a gpu, use bf16 on cpu.")
+        return torch.bfloat16, False
+    if precision == "bf16" and not torch.cuda.is_bf16_supported():
+        print("[!] bf16 is not supported by this gpu, use fp16.")
+        precision = "fp16"
+    if precision == "fp16":
+        return torch.float16, True
+    return torch.bfloat16, False
+
+
+class precision_policy:
+    def __init__(self, precision="fp32", device_type="cpu"):
+        self.device_type = device_type
+        self.dtype, use_scaler = resolve_precision(precision, device_type)
+        self.scaler = None
+        if use_scaler:
+            self.scaler = torch.cuda.amp.GradScaler()
+        self.name = {None: "fp32", torch.bfloat16: "bf16", torch.float16: "fp16"}[
+            self.dtype
+        ]
+
+    def autocast(self):
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def scale(self, loss):
+        """ loss (or network output) to differentiate. """
+        if self.scaler is None:
+            return loss
+        return self.scaler.scale(loss)
+
+    def unscale(self, grad):
+        """ gradient taken through scale() back to its true value, for terms that
+        use it in the loss (e.g. the gradient penalty). """
+        if self.scaler is None:
+            return grad
+        return grad * (1.0 / self.scaler.get_scale())
+
+    def step(self, opt):
+        # with a scaler, steps with inf/nan gradients are skipped.
+        if self.scaler is None:
+            opt.step()
+        else:
+            self.scaler.step(opt)
+
+    def update(self):
+        # once per iteration, after all the optimizer steps.
+        if self.scaler is not None:
+            self.scaler.update()
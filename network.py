@@ -5,6 +5,7 @@ import numpy as np
 from torch.autograd import Variable
 from custom_layers import *
 import copy
+from collections import OrderedDict
 
 
 # defined for code simplicity.
@@ -82,23 +83,66 @@ def linear(layers, c_in, c_out, sig=True, wn=False):
     return layers
 
 
-def deepcopy_module(module, target):
+def wrap_module(module, target):
+    """ nn.Sequential holding the child named target of module, by reference. """
     new_module = nn.Sequential()
     for name, m in module.named_children():
         if name == target:
-            new_module.add_module(name, m)  # make new structure and,
-            new_module[-1].load_state_dict(m.state_dict())  # copy weights
+            new_module.add_module(name, m)
     return new_module
 
 
+def splice(model, head=(), drop=(), tail=()):
+    """ new nn.Sequential made of head + the children of model not in drop + tail,
+    all given as (name, module). modules (and their parameters) are reused by
+    reference, no weight is copied. """
+    children = [(n, m) for n, m in model.named_children() if n not in drop]
+    return nn.Sequential(OrderedDict(list(head) + children + list(tail)))
+
+
 def soft_copy_param(target_link, source_link, tau):
-    """ soft-copy parameters of a link to another link. """
-    target_params = dict(target_link.named_parameters())
-    for param_name, param in source_link.named_parameters():
-        target_params[param_name].data = target_params[param_name].data.mul(1.0 - tau)
-        target_params[param_name].data = target_params[param_name].data.add(
-            param.data.mul(tau)
-        )
+    """ soft-copy parameters of a link to another link (same structure), in place. """
+    with torch.no_grad():
+        target_params = [p.data for p in target_link.parameters()]
+        source_params = [p.data for p in source_link.parameters()]
+        if hasattr(torch, "_foreach_lerp_"):
+            # one fused multi-tensor kernel, no temporary allocation.
+            torch._foreach_lerp_(target_params, source_params, tau)
+        else:
+            for target, source in zip(target_params, source_params):
+                target.lerp_(source, tau)
+
+
+def copy_new_modules(target_link, source_link, known):
+    """ initialize the modules of target_link whose id is not in known (e.g. blocks
+    added by grow_network) from the modules of source_link with the same name. """
+    source_modules = dict(source_link.named_modules())
+    with torch.no_grad():
+        for name, module in target_link.named_modules():
+            if id(module) in known:
+                continue
+            source = source_modules[name]
+            for param_name, param in module.named_parameters(recurse=False):
+                param.copy_(getattr(source, param_name))
+            if hasattr(source, "scale"):
+                module.scale = source.scale  # equalized learning rate constant.
+
+
+def get_scales(model):
+    """ runtime scales of the equalized learning rate layers, keyed like a
+    state_dict (they are not part of it, and are drawn at initialization). """
+    return {
+        name + ".scale": m.scale.detach().clone()
+        for name, m in model.named_modules()
+        if isinstance(m, (equalized_conv2d, equalized_deconv2d, equalized_linear))
+    }
+
+
+def load_scales(model, scales):
+    modules = dict(model.named_modules())
+    with torch.no_grad():
+        for key, scale in scales.items():
+            modules[key[: -len(".scale")]].scale.copy_(scale)
 
 
 def get_module_names(model):
@@ -259,16 +303,6 @@ class Generator(nn.Module):
         return model
 
     def grow_network(self, resl):
-        # we make new network since pytorch does not support remove_module()
-        new_model = nn.Sequential()
-        names = get_module_names(self.model)
-        for name, module in self.model.named_children():
-            if not name == "to_rgb_block":
-                new_model.add_module(name, module)  # make new structure and,
-                new_model[-1].load_state_dict(
-                    module.state_dict()
-                )  # copy pretrained weights
-
         if resl >= 3 and resl <= 9:
             # print(
             #     "growing network[{}x{} to {}x{}]. It may take few seconds...".format(
@@ -278,7 +312,7 @@ class Generator(nn.Module):
             #         int(pow(2, resl)),
             #     )
             # )
-            low_resl_to_rgb = deepcopy_module(self.model, "to_rgb_block")
+            low_resl_to_rgb = wrap_module(self.model, "to_rgb_block")
             prev_block = nn.Sequential()
             prev_block.add_module(
                 "low_resl_upsample", nn.Upsample(scale_factor=2, mode="nearest")
@@ -290,38 +324,51 @@ class Generator(nn.Module):
             next_block.add_module("high_resl_block", inter_block)
             next_block.add_module("high_resl_to_rgb", self.to_rgb_block(ndim))
 
-            new_model.add_module("concat_block", ConcatTable(prev_block, next_block))
-            new_model.add_module("fadein_block", fadein_layer(self.config))
-            self.model = None
-            self.model = new_model
+            # replace to_rgb_block with the fade-in branches, the other blocks
+            # are kept as they are.
+            self.model = splice(
+                self.model,
+                drop=["to_rgb_block"],
+                tail=[
+                    ("concat_block", ConcatTable(prev_block, next_block)),
+                    ("fadein_block", fadein_layer(self.config)),
+                ],
+            )
             self.module_names = get_module_names(self.model)
 
     def flush_network(self):
-        try:
-            # print("flushing network... It may take few seconds...")
-            # make deep copy and paste.
-            high_resl_block = deepcopy_module(
-                self.model.concat_block.layer2, "high_resl_block"
-            )
-            high_resl_to_rgb = deepcopy_module(
-                self.model.concat_block.layer2, "high_resl_to_rgb"
-            )
+        if not hasattr(self.model, "concat_block"):
+            return
+        # drop the fade-in branches, and keep the high resolution ones.
+        layer2 = self.model.concat_block.layer2
+        self.model = splice(
+            self.model,
+            drop=["concat_block", "fadein_block"],
+            tail=[
+                (self.layer_name, wrap_module(layer2, "high_resl_block")),
+                ("to_rgb_block", wrap_module(layer2, "high_resl_to_rgb")),
+            ],
+        )
+        self.module_names = get_module_names(self.model)
 
-            new_model = nn.Sequential()
-            for name, module in self.model.named_children():
-                if name != "concat_block" and name != "fadein_block":
-                    new_model.add_module(name, module)  # make new structure and,
-                    new_model[-1].load_state_dict(
-                        module.state_dict()
-                    )  # copy pretrained weights
-
-            # now, add the high resolution block.
-            new_model.add_module(self.layer_name, high_resl_block)
-            new_model.add_module("to_rgb_block", high_resl_to_rgb)
-            self.model = new_model
-            self.module_names = get_module_names(self.model)
-        except:
-            self.model = self.model
+    def build_flushed(self, resl):
+        """ the network grown and flushed up to resl, built directly: same module
+        names (and state_dict keys) as grow_network + flush_network, without
+        building and splicing the fade-in branches of every resolution. """
+        model = nn.Sequential()
+        first_block, ndim = self.first_block()
+        model.add_module("first_block", first_block)
+        to_rgb_block = self.to_rgb_block(ndim)
+        for r in range(3, resl + 1):
+            inter_block, ndim, self.layer_name = self.intermediate_block(r)
+            block = nn.Sequential()
+            block.add_module("high_resl_block", inter_block)
+            model.add_module(self.layer_name, block)
+            to_rgb_block = nn.Sequential()
+            to_rgb_block.add_module("high_resl_to_rgb", self.to_rgb_block(ndim))
+        model.add_module("to_rgb_block", to_rgb_block)
+        self.model = model
+        self.module_names = get_module_names(self.model)
 
     def freeze_layers(self):
         # let's freeze pretrained blocks. (Found freezing layers not helpful, so did not use this func.)
@@ -354,7 +401,7 @@ class Discriminator(nn.Module):
         # add minibatch_std_concat_layer later.
         ndim = self.ndf
         layers = []
-        layers.append(minibatch_std_concat_layer())
+        layers.append(minibatch_std_concat_layer(group_size=self.config.mbstd_group))
         layers = conv(
             layers,
             ndim + 1,
@@ -489,7 +536,7 @@ class Discriminator(nn.Module):
             #         int(pow(2, resl)),
             #     )
             # )
-            low_resl_from_rgb = deepcopy_module(self.model, "from_rgb_block")
+            low_resl_from_rgb = wrap_module(self.model, "from_rgb_block")
             prev_block = nn.Sequential()
             prev_block.add_module("low_resl_downsample", nn.AvgPool2d(kernel_size=2))
             prev_block.add_module("low_resl_from_rgb", low_resl_from_rgb)
@@ -499,50 +546,32 @@ class Discriminator(nn.Module):
             next_block.add_module("high_resl_from_rgb", self.from_rgb_block(ndim))
             next_block.add_module("high_resl_block", inter_block)
 
-            new_model = nn.Sequential()
-            new_model.add_module("concat_block", ConcatTable(prev_block, next_block))
-            new_model.add_module("fadein_block", fadein_layer(self.config))
-
-            # we make new network since pytorch does not support remove_module()
-            names = get_module_names(self.model)
-            for name, module in self.model.named_children():
-                if not name == "from_rgb_block":
-                    new_model.add_module(name, module)  # make new structure and,
-                    new_model[-1].load_state_dict(
-                        module.state_dict()
-                    )  # copy pretrained weights
-            self.model = None
-            self.model = new_model
+            # replace from_rgb_block with the fade-in branches, the other blocks
+            # are kept as they are.
+            self.model = splice(
+                self.model,
+                head=[
+                    ("concat_block", ConcatTable(prev_block, next_block)),
+                    ("fadein_block", fadein_layer(self.config)),
+                ],
+                drop=["from_rgb_block"],
+            )
             self.module_names = get_module_names(self.model)
 
     def flush_network(self):
-        try:
-            # print("flushing network... It may take few seconds...")
-            # make deep copy and paste.
-            high_resl_block = deepcopy_module(
-                self.model.concat_block.layer2, "high_resl_block"
-            )
-            high_resl_from_rgb = deepcopy_module(
-                self.model.concat_block.layer2, "high_resl_from_rgb"
-            )
-
-            # add the high resolution block.
-            new_model = nn.Sequential()
-            new_model.add_module("from_rgb_block", high_resl_from_rgb)
-            new_model.add_module(self.layer_name, high_resl_block)
-
-            # add rest.
-            for name, module in self.model.named_children():
-                if name != "concat_block" and name != "fadein_block":
-                    new_model.add_module(name, module)  # make new structure and,
-                    new_model[-1].load_state_dict(
-                        module.state_dict()
-                    )  # copy pretrained weights
-
-            self.model = new_model
-            self.module_names = get_module_names(self.model)
-        except:
-            self.model = self.model
+        if not hasattr(self.model, "concat_block"):
+            return
+        # drop the fade-in branches, and keep the high resolution ones.
+        layer2 = self.model.concat_block.layer2
+        self.model = splice(
+            self.model,
+            head=[
+                ("from_rgb_block", wrap_module(layer2, "high_resl_from_rgb")),
+                (self.layer_name, wrap_module(layer2, "high_resl_block")),
+            ],
+            drop=["concat_block", "fadein_block"],
+        )
+        self.module_names = get_module_names(self.model)
 
     def freeze_layers(self):
         # let's freeze pretrained blocks. (Found freezing layers not helpful, so did not use this func.)
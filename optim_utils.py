@@ -0,0 +1,72 @@
+""" optim_utils.py
+keep optimizer state across network growth.
+
+parameters keep their identity through grow_network/flush_network, so the
+optimizer is updated in place: surviving parameters keep their adam moments,
+new blocks are added as a new param group, and flushed blocks are removed.
+checkpoints store the state keyed by parameter names (named_parameters()),
+so that it can be restored into a freshly built optimizer whatever the
+order of its param groups.
+"""
+from collections import defaultdict
+
+import torch
+
+
+def sync_param_groups(opt, params):
+    """ make opt optimize exactly params (those requiring grad), in place. """
+    params = [p for p in params if p.requires_grad]
+    current = set(id(p) for p in params)
+
+    # remove the parameters (and their state) that are not in the network anymore.
+    for group in opt.param_groups:
+        for p in group["params"]:
+            if id(p) not in current:
+                opt.state.pop(p, None)
+        group["params"] = [p for p in group["params"] if id(p) in current]
+    defaults = opt.defaults
+    if opt.param_groups:
+        defaults = {k: v for k, v in opt.param_groups[0].items() if k != "params"}
+    opt.param_groups = [g for g in opt.param_groups if g["params"]]
+
+    # new parameters join as a new group, with the current hyper-parameters.
+    known = set(id(p) for g in opt.param_groups for p in g["params"])
+    new_params = [p for p in params if id(p) not in known]
+    if new_params:
+        opt.add_param_group(dict(defaults, params=new_params))
+    return len(new_params)
+
+
+def state_dict_by_name(opt, model):
+    names = {id(p): name for name, p in model.named_parameters()}
+    state = {names[id(p)]: s for p, s in opt.state.items() if id(p) in names}
+    groups = []
+    for group in opt.param_groups:
+        group = dict(group)
+        group["params"] = [names[id(p)] for p in group["params"] if id(p) in names]
+        groups.append(group)
+    return {"state": state, "param_groups": groups, "by_name": True}
+
+
+def load_state_dict_by_name(opt, model, state_dict):
+    """ restore a state saved with state_dict_by_name. parameters of model that
+    are not in the saved state start from scratch. """
+    params = dict(model.named_parameters())
+    opt.param_groups = []
+    opt.state = defaultdict(dict)
+    for group in state_dict["param_groups"]:
+        group = dict(group)
+        group["params"] = [params[n] for n in group["params"] if n in params]
+        if group["params"]:
+            opt.add_param_group(group)
+    sync_param_groups(opt, params.values())
+
+    for name, state in state_dict["state"].items():
+        if name not in params:
+            continue
+        p = params[name]
+        # adam keeps its step counter on the host.
+        opt.state[p] = {
+            k: v.to(p.device) if torch.is_tensor(v) and k != "step" else v
+            for k, v in state.items()
+        }
@@ -0,0 +1,102 @@
+""" preview.py
+exports image grids off the training thread. the training thread only
+normalizes the images and copies them to host memory as uint8; grid
+assembly, resizing and jpeg encoding are done by a bounded pool of worker
+threads. when the workers fall behind, new previews are dropped instead of
+blocking training (unless block=True).
+"""
+import os
+import time
+import queue
+import threading
+import traceback
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def to_uint8_batch(x, nimg):
+    """ first nimg images of x as a host uint8 NHWC tensor, normalized over their
+    min/max (and padded with ones) exactly like utils.make_image_grid. """
+    x = x.detach()[:nimg].float()
+    if x.size(0) < nimg:
+        pad = x.new_ones(nimg - x.size(0), x.size(1), x.size(2), x.size(3))
+        x = torch.cat([x, pad], 0)
+    lo, hi = x.min(), x.max()
+    x = x.clamp(lo, hi).sub_(lo).div_(hi - lo)
+    return x.mul_(255).clamp_(0, 255).byte().permute(0, 2, 3, 1).cpu()
+
+
+def save_uint8_grid(batch, path, ngrid, imsize):
+    arr = batch.numpy()
+    n, h, w, c = arr.shape
+    if c == 1:  # single-channel, convert to 3-channel.
+        arr = np.repeat(arr, 3, axis=3)
+        c = 3
+    grid = arr.reshape(ngrid, ngrid, h, w, c).transpose(0, 2, 1, 3, 4)
+    im = Image.fromarray(np.ascontiguousarray(grid.reshape(ngrid * h, ngrid * w, c)))
+    if imsize is not None:
+        im = im.resize((imsize, imsize), Image.NEAREST)
+    im.save(path)
+
+
+class preview_exporter:
+    def __init__(self, max_pending=4, n_workers=1, block=False):
+        self.block = block
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.dirs = set()
+        self.dirs_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.submit_time = 0.0
+        self.threads = [
+            threading.Thread(target=self.run, daemon=True) for _ in range(n_workers)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, x, path, ngrid=4, imsize=512):
+        """ x: batch of images in any range/device. ngrid=1 saves the first image only. """
+        start = time.perf_counter()
+        if not self.block and self.queue.full():
+            self.dropped = self.dropped + 1
+        else:
+            job = (to_uint8_batch(x, ngrid * ngrid), path, ngrid, imsize)
+            try:
+                self.queue.put(job, block=self.block)
+                self.enqueued = self.enqueued + 1
+            except queue.Full:
+                self.dropped = self.dropped + 1
+        self.submit_time = self.submit_time + time.perf_counter() - start
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            batch, path, ngrid, imsize = job
+            try:
+                folder = os.path.dirname(path)
+                with self.dirs_lock:
+                    if folder not in self.dirs:
+                        os.makedirs(folder, exist_ok=True)
+                        self.dirs.add(folder)
+                save_uint8_grid(batch, path, ngrid, imsize)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        submitted = self.enqueued + self.dropped
+        return {
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "avg_submit_ms": 1000.0 * self.submit_time / max(1, submitted),
+        }
+
+    def close(self):
+        # wait for pending previews to be written.
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
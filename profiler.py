@@ -0,0 +1,185 @@
+""" profiler.py
+where the time of a training step goes. the trainer wraps each stage of a step
+(data fetch, interpolation, noise, forward passes, gradient penalty, updates,
+snapshots, previews, tensorboard) in a named span:
+
+    with profiler.span("gradient_penalty"):
+        ...
+
+span times are summed per tick and per phase (gtrns, gstab, dtrns, dstab),
+written to repo/profile/ticks.csv and repo/profile/phases.json, and to
+tensorboard. optionally, a torch.profiler trace of a few steps at a given
+resolution is written to repo/profile/trace (open it with tensorboard or
+chrome://tracing). when disabled, span() returns a shared no-op context.
+"""
+import os
+import csv
+import json
+import time
+from collections import OrderedDict
+
+import torch
+
+
+class null_span:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = null_span()
+
+
+class timed_span:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.profiler.trace is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.sync:
+            torch.cuda.synchronize()  # count the kernels of the span, not their launch.
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        return False
+
+
+class step_profiler:
+    def __init__(
+        self,
+        enabled=False,
+        out_dir="repo/profile",
+        trace_resl=0,
+        trace_steps=0,
+        recorder=None,
+    ):
+        """
+        trace_resl: log2 of the resolution at which a torch.profiler trace of
+        trace_steps steps is taken (0: no trace).
+        recorder: tf_recorder receiving the per-tick times (or None).
+        """
+        self.enabled = enabled
+        self.out_dir = out_dir
+        self.trace_resl = trace_resl
+        self.trace_steps = trace_steps
+        self.recorder = recorder
+        self.sync = enabled and torch.cuda.is_available()
+        self.trace = None
+        self.traced = 0
+        self.tick = None
+        self.phase = None
+        self.resl = None
+        self.n_steps = 0
+        self.step_spans = OrderedDict()  # name: [calls, seconds] in the current step.
+        self.tick_spans = OrderedDict()  # name: [calls, seconds] in the current tick.
+        self.phase_spans = OrderedDict()  # phase: {"steps": n, "spans": {name: ...}}
+        if enabled:
+            os.makedirs(out_dir, exist_ok=True)
+            self.csv_file = open(os.path.join(out_dir, "ticks.csv"), "w", newline="")
+            self.csv = csv.writer(self.csv_file)
+            self.csv.writerow(
+                ["tick", "phase", "resl", "span", "calls", "total_ms", "ms_per_step"]
+            )
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return timed_span(self, name)
+
+    def add(self, name, seconds, calls=1, spans=None):
+        spans = self.step_spans if spans is None else spans
+        stat = spans.setdefault(name, [0, 0.0])
+        stat[0] = stat[0] + calls
+        stat[1] = stat[1] + seconds
+
+    def step(self, tick, phase, resl):
+        """ end of a training step: tick, phase and resolution (log2) it belonged to. """
+        if not self.enabled:
+            return
+        if self.tick is not None and (tick != self.tick or phase != self.phase):
+            self.flush()
+        self.tick, self.phase, self.resl = tick, phase, resl
+        for name, (calls, seconds) in self.step_spans.items():
+            self.add(name, seconds, calls, self.tick_spans)
+        self.step_spans = OrderedDict()
+        self.n_steps = self.n_steps + 1
+        self.step_trace(resl)
+
+    def step_trace(self, resl):
+        if self.trace is not None:
+            self.trace.step()
+            self.traced = self.traced + 1
+            if self.traced >= self.trace_steps:
+                self.trace.stop()
+                self.trace = None
+                print("[profile] trace written to {}/trace".format(self.out_dir))
+        elif resl == self.trace_resl and self.traced == 0 and self.trace_steps > 0:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                record_shapes=True,
+                profile_memory=True,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    os.path.join(self.out_dir, "trace")
+                ),
+            )
+            self.trace.start()
+
+    def flush(self):
+        """ write the spans of the finished tick, and add them to its phase. """
+        if not self.tick_spans:
+            return
+        phase = self.phase_spans.setdefault(self.phase, {"steps": 0, "spans": {}})
+        phase["steps"] = phase["steps"] + self.n_steps
+        for name, (calls, seconds) in self.tick_spans.items():
+            per_step = 1000.0 * seconds / max(1, self.n_steps)
+            self.csv.writerow(
+                [self.tick, self.phase, pow(2, self.resl), name, calls]
+                + ["{:.3f}".format(1000.0 * seconds), "{:.3f}".format(per_step)]
+            )
+            self.add(name, seconds, calls, phase["spans"])
+            if self.recorder is not None:
+                self.recorder.add_scalar("profile/" + name, per_step, self.tick)
+        self.csv_file.flush()
+        self.tick_spans = OrderedDict()
+        self.n_steps = 0
+
+    def summary(self):
+        """ per phase: steps, and total / per-step milliseconds of every span. """
+        return {
+            phase: {
+                "steps": stats["steps"],
+                "spans": {
+                    name: {
+                        "calls": calls,
+                        "total_ms": 1000.0 * seconds,
+                        "ms_per_step": 1000.0 * seconds / max(1, stats["steps"]),
+                    }
+                    for name, (calls, seconds) in stats["spans"].items()
+                },
+            }
+            for phase, stats in self.phase_spans.items()
+        }
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.flush()
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        self.csv_file.close()
+        with open(os.path.join(self.out_dir, "phases.json"), "w") as f:
+            json.dump(self.summary(), f, indent=2)
@@ -0,0 +1,135 @@
+""" pyramid_cache.py
+decode every training image once, and store all the power-of-two resolutions
+(4x4 ~ 2^max_resl) as memory-mappable uint8 arrays, one per resolution:
+
+<data_cache>/pyramid_<hash of train_data_root>/
+                |--index.json       (source fingerprint, samples and levels)
+                |--resl_2.npy       (N x 4 x 4 x 3)
+                |--resl_3.npy       (N x 8 x 8 x 3) ...
+
+the cache is rebuilt when the source folder (file list, sizes, mtimes) or
+max_resl changes.
+"""
+import os
+import json
+import hashlib
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision.datasets import ImageFolder
+from PIL import Image
+
+
+def source_fingerprint(samples, max_resl):
+    sha = hashlib.sha1()
+    sha.update("max_resl={}".format(max_resl).encode())
+    for path, label in samples:
+        st = os.stat(path)
+        sha.update(
+            "{}|{}|{}|{}".format(path, label, st.st_size, st.st_mtime_ns).encode()
+        )
+    return sha.hexdigest()
+
+
+def decode_pyramid(args):
+    # same decoding as ImageFolder + transforms.Resize(..., NEAREST), done once
+    # from the full-size image for every level.
+    path, resls = args
+    with open(path, "rb") as f:
+        im = Image.open(f).convert("RGB")
+    return [np.asarray(im.resize((pow(2, r), pow(2, r)), Image.NEAREST)) for r in resls]
+
+
+def build_pyramid(root, cache_dir, max_resl, num_workers=4):
+    samples = ImageFolder(root=root).samples
+    fingerprint = source_fingerprint(samples, max_resl)
+    index_path = os.path.join(cache_dir, "index.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        if index["fingerprint"] == fingerprint:
+            return index
+        print("[*] source folder changed, rebuilding pyramid cache.")
+
+    print(
+        "[*] Build pyramid cache of {} images (4x4 ~ {}x{}) in {}.".format(
+            len(samples), pow(2, max_resl), pow(2, max_resl), cache_dir
+        )
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(index_path):
+        os.remove(index_path)  # invalidate before touching the levels.
+    resls = list(range(2, max_resl + 1))
+    levels = {}
+    arrays = {}
+    for r in resls:
+        levels[str(r)] = "resl_{}.npy".format(r)
+        arrays[r] = np.lib.format.open_memmap(
+            os.path.join(cache_dir, levels[str(r)] + ".tmp"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(samples), pow(2, r), pow(2, r), 3),
+        )
+
+    jobs = [(path, resls) for path, _ in samples]
+    with Pool(max(1, num_workers)) as pool:
+        for i, pyramid in enumerate(pool.imap(decode_pyramid, jobs, chunksize=16)):
+            for r, arr in zip(resls, pyramid):
+                arrays[r][i] = arr
+
+    for r in resls:
+        arrays[r].flush()
+        del arrays[r]
+        path = os.path.join(cache_dir, levels[str(r)])
+        os.replace(path + ".tmp", path)
+
+    index = {
+        "root": root,
+        "fingerprint": fingerprint,
+        "max_resl": max_resl,
+        "samples": samples,
+        "levels": levels,
+    }
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)  # index is written last.
+    return index
+
+
+def load_or_build(root, data_cache, max_resl, num_workers=4):
+    key = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:12]
+    cache_dir = os.path.join(data_cache, "pyramid_{}".format(key))
+    index = build_pyramid(root, cache_dir, max_resl, num_workers)
+    index["cache_dir"] = cache_dir
+    return index
+
+
+class pyramid_dataset(Dataset):
+    """ reads one level of the pyramid cache. items are (CxHxW float in [0,1], label),
+    exactly as ImageFolder + ToTensor would return them (or CxHxW uint8 with
+    uint8=True, as PILToTensor would). """
+
+    def __init__(self, index, resl, uint8=False):
+        assert str(resl) in index["levels"], "resolution not in pyramid cache"
+        self.path = os.path.join(index["cache_dir"], index["levels"][str(resl)])
+        self.labels = [label for _, label in index["samples"]]
+        self.uint8 = uint8
+        self.data = None  # opened lazily, so that each worker maps its own view.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = None  # never pickle the mapped array to workers.
+        return state
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if self.data is None:
+            self.data = np.load(self.path, mmap_mode="r")
+        img = torch.from_numpy(np.array(self.data[idx])).permute(2, 0, 1)
+        if self.uint8:
+            return img.contiguous(), self.labels[idx]
+        return img.float().div(255), self.labels[idx]
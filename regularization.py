@@ -0,0 +1,36 @@
+""" regularization.py
+lazy regularization: the gradient penalty (and the epsilon drift term) of the
+D step are only computed every k steps, with their weight multiplied by k, so
+that their average contribution stays the same. steps without regularization
+skip the double backward, and its memory. the penalty can also be computed on
+a sub-batch of the reals (with a separate D pass over it).
+"""
+
+
+class lazy_regularizer:
+    def __init__(self, config):
+        # regularize every k D steps, per resolution (like dataloader.batch_table).
+        self.every_table = {
+            4: config.reg_every,
+            8: config.reg_every,
+            16: config.reg_every,
+            32: config.reg_every,
+            64: config.reg_every,
+            128: config.reg_every,
+            256: config.reg_every,
+            512: config.reg_every,
+            1024: config.reg_every,
+        }
+        self.batch_fraction = config.reg_batch_fraction
+        self.n_steps = 0  # D steps so far.
+
+    def step(self, imsize):
+        """ weight of the regularization terms of this D step (0: not regularized). """
+        every = max(1, int(self.every_table[imsize]))
+        due = self.n_steps % every == 0
+        self.n_steps = self.n_steps + 1
+        return float(every) if due else 0.0
+
+    def sub_batch(self, batchsize):
+        """ number of reals the penalty is computed on (all of them: batchsize). """
+        return min(batchsize, max(1, int(round(batchsize * self.batch_fraction))))
@@ -6,11 +6,20 @@ import utils as utils
 from torchvision import datasets
 from tensorboardX import SummaryWriter
 import os, sys
+import queue
+import threading
+import traceback
 import utils as utils
 
 
 class tf_recorder:
-    def __init__(self):
+    """ tensorboard writer fed through a queue. the training thread only enqueues
+    events (copying tensors to host memory for images and histograms); a writer
+    thread drains the queue in batches and serializes them. scalars may be given
+    as device tensors, they are read by the writer thread. images are dropped
+    when max_pending_images of them are still waiting. """
+
+    def __init__(self, max_pending=10000, max_pending_images=8):
         utils.mkdir("repo/tensorboard")
 
         for i in range(1000):
@@ -18,21 +27,41 @@ class tf_recorder:
             if not os.path.exists(self.targ):
                 self.writer = SummaryWriter(self.targ)
                 break
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.image_slots = threading.BoundedSemaphore(max_pending_images)
+        self.enqueued = 0
+        self.dropped = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, event, droppable=False):
+        if droppable:
+            # images are dropped when the writer falls behind.
+            if not self.image_slots.acquire(blocking=False):
+                self.dropped = self.dropped + 1
+                return
+        self.queue.put(event + (droppable,))
+        self.enqueued = self.enqueued + 1
 
     def add_scalar(self, index, val, niter):
-        self.writer.add_scalar(index, val, niter)
+        self.put(("scalar", index, val, niter))
 
     def add_scalars(self, index, group_dict, niter):
-        self.writer.add_scalar(index, group_dict, niter)
+        self.put(("scalars", index, group_dict, niter))
 
     def add_image_grid(self, index, ngrid, x, niter):
-        grid = utils.make_image_grid(x, ngrid)
-        self.writer.add_image(index, grid, niter)
+        x = x.detach()[: ngrid * ngrid].float().cpu()
+        self.put(("image_grid", index, (ngrid, x), niter), droppable=True)
 
     def add_image_single(self, index, x, niter):
-        self.writer.add_image(index, x, niter)
+        self.put(("image", index, x.detach().float().cpu(), niter), droppable=True)
+
+    def add_histogram(self, index, x, niter):
+        self.put(("histogram", index, x.detach().float().cpu(), niter))
 
     def add_graph(self, index, x_input, model):
+        self.flush()
         torch.onnx.export(
             model,
             x_input,
@@ -42,8 +71,63 @@ class tf_recorder:
         self.writer.add_graph_onnx(os.path.join(self.targ, "{}.proto".format(index)))
 
     def export_json(self, out_file):
+        self.flush()
         self.writer.export_scalars_to_json(out_file)
 
+    def run(self):
+        while True:
+            events = [self.queue.get()]
+            # write everything that is pending at once.
+            while len(events) < 256:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for event in events:
+                if event is None:
+                    continue
+                try:
+                    self.write(*event)
+                except Exception:
+                    traceback.print_exc()
+            self.batches = self.batches + 1
+            self.writer.flush()
+            for _ in events:
+                self.queue.task_done()
+            if None in events:
+                break
+
+    def write(self, kind, index, val, niter, droppable):
+        if droppable:
+            self.image_slots.release()
+        if kind == "scalar":
+            self.writer.add_scalar(index, float(val), niter)
+        elif kind == "scalars":
+            self.writer.add_scalars(index, {k: float(v) for k, v in val.items()}, niter)
+        elif kind == "image_grid":
+            ngrid, x = val
+            self.writer.add_image(index, utils.make_image_grid(x, ngrid), niter)
+        elif kind == "image":
+            self.writer.add_image(index, val, niter)
+        elif kind == "histogram":
+            self.writer.add_histogram(index, val.numpy(), niter)
+
+    def flush(self):
+        """ wait until every event enqueued so far is written. """
+        self.queue.join()
+
+    def stats(self):
+        return {
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+
 
 """
 resnet18 = models.resnet18(False)
@@ -1,15 +1,27 @@
 import dataloader as DL
 from config import config
 import network as net
+import custom_layers
 from math import floor, ceil
 import os, sys
+import copy
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 from torch.autograd import Variable
 from torch.optim import Adam
 from tqdm import tqdm
 import tf_recorder as tensorboard
 import utils as utils
+import checkpoint
+import optim_utils
+import mixed_precision
+import dist_utils
+import autotune
+import profiler
+import metrics
+import regularization
+import preview
 import numpy as np
 from multiprocessing import Manager, Value
 from torch.autograd import grad as torch_grad
@@ -28,6 +40,115 @@ def accelerate(value):
     return value * 2
 
 
+def interpolate_low_resl(x):
+    # nearest down-sampling (x0.5) then up-sampling (x2) of the whole batch on
+    # its own device. PIL's NEAREST resize keeps the odd pixels, so do we.
+    return F.interpolate(x[:, :, 1::2, 1::2], scale_factor=2, mode="nearest")
+
+
+# losses of trainer.train (also used by benchmark.train_step).
+def loss_d_adv(mse, fx, fx_tilde, real_label, fake_label):
+    """ least-squares D loss: D(x) towards real_label, D(G(z)) towards fake_label. """
+    return mse(fx.squeeze(), real_label) + mse(fx_tilde.squeeze(), fake_label)
+
+
+def loss_g_adv(mse, fx_tilde, real_label):
+    return mse(fx_tilde.squeeze(), real_label)
+
+
+def gradient_penalty(gradients, wgan_lambda):
+    # Gradients have shape (batch_size, num_channels, img_width, img_height),
+    # so flatten to easily take norm per example in batch
+    gradients = gradients.reshape(gradients.size(0), -1)
+    # Derivatives of the gradient close to 0 can cause problems because of
+    # the square root, so manually calculate norm and add epsilon
+    gradients_norm = torch.sqrt(torch.sum(gradients ** 2, dim=1) + 1e-12)
+
+    # Return gradient penalty
+    return wgan_lambda * ((gradients_norm - 1) ** 2).mean()
+
+
+def d_step_loss(
+    G,
+    D,
+    x,
+    z,
+    real_label,
+    fake_label,
+    mse,
+    amp,
+    reg_weight=1.0,
+    reg_batch=None,
+    wgan_lambda=10.0,
+    wgan_epsilon=0.001,
+    fused=False,
+    keep_g_graph=True,
+    prof=None,
+):
+    """ forward passes and loss of the D step of trainer.train (also used by
+    benchmark.train_step) on one (micro-)batch of reals x and latents z.
+    reg_weight: weight of the gradient and epsilon penalties (0: none), the
+    gradient penalty on the first reg_batch reals (None: all of them). fused:
+    reals and fakes in a single D pass (--flag_fused_d). keep_g_graph: False
+    when G is run again in the G step. prof: profiler.step_profiler timing the
+    passes. returns (loss_d, x_tilde, fx, fx_tilde). """
+    span = prof.span if prof is not None else (lambda name: profiler.NULL_SPAN)
+    reg_batch = x.size(0) if reg_batch is None else reg_batch
+    # gradients w.r.t. the reals are only needed for the penalty.
+    full_reg = bool(reg_weight) and reg_batch >= x.size(0)
+    x_real = x.detach().requires_grad_(full_reg)
+    with span("forward_d"), amp.autocast():
+        if keep_g_graph:
+            x_tilde = G(z)
+        else:
+            with torch.no_grad():
+                x_tilde = G(z)
+        # losses are computed in fp32.
+        if fused:
+            # reals and fakes in one pass, minibatch-std per half.
+            x_all = torch.cat([x_real, x_tilde.detach()], 0)
+            with custom_layers.split_batch(D, 2):
+                fx, fx_tilde = D(x_all).float().chunk(2)
+        else:
+            fx = D(x_real).float()
+            fx_tilde = D(x_tilde.detach()).float()
+
+    loss_d = loss_d_adv(mse, fx, fx_tilde, real_label, fake_label)
+    if reg_weight:
+        ### gradient penalty
+        with span("gradient_penalty"):
+            x_reg, fx_reg = x_real, fx
+            if not full_reg:
+                # separate pass over the first reals.
+                x_reg = x[:reg_batch].detach().requires_grad_()
+                with amp.autocast():
+                    fx_reg = D(x_reg).float()
+            gradients = torch_grad(
+                outputs=amp.scale(fx_reg),
+                inputs=x_reg,
+                grad_outputs=torch.ones_like(fx_reg),
+                create_graph=True,
+                retain_graph=True,
+            )[0]
+            gradients = amp.unscale(gradients)
+        loss_d = loss_d + gradient_penalty(gradients, wgan_lambda) * reg_weight
+
+        ### epsilon penalty
+        loss_d = loss_d + (fx ** 2).mean() * wgan_epsilon * reg_weight
+    return loss_d, x_tilde, fx, fx_tilde
+
+
+def g_step_loss(G, D, x_tilde, z, real_label, mse, amp, prof=None):
+    """ loss of the G step of trainer.train on one (micro-)batch: on the fakes
+    x_tilde of the D step, or on G(z) again if z is given. """
+    span = prof.span if prof is not None else (lambda name: profiler.NULL_SPAN)
+    with span("forward_g"), amp.autocast():
+        if z is not None:
+            x_tilde = G(z)
+        fx_tilde = D(x_tilde).float()
+    return loss_g_adv(mse, fx_tilde, real_label)
+
+
 class trainer:
     def __init__(self, config):
         self.config = config
@@ -37,6 +158,11 @@ class trainer:
         else:
             self.use_cuda = False
             torch.set_default_tensor_type("torch.FloatTensor")
+        self.is_main = dist_utils.is_main()  # rank 0 does all the i/o.
+        # noise of add_noise and of the generalized dropout layers, drawn on
+        # the training device (different on every rank).
+        self.rng = torch.Generator(device="cuda" if self.use_cuda else "cpu")
+        self.rng.manual_seed(config.random_seed + dist_utils.get_rank())
 
         self.nz = config.nz
         self.optimizer = config.optimizer
@@ -58,24 +184,43 @@ class trainer:
         self.stack = 0
         self.wgan_lambda = 10.0
         self.just_passed = False
+        self.ckpt_writer = None
+        self.last_snapshot_tick = -1
         if self.config.resume:
-            saved_models = os.listdir("repo/model/")
-            iterations = list(
-                map(lambda x: int(x.split("_")[-1].split(".")[0][1:]), saved_models)
-            )
-            self.last_iteration = max(iterations)
-            selected_indexes = np.where([x == self.last_iteration for x in iterations])[
-                0
-            ]
-            G_last_model = [
-                saved_models[x] for x in selected_indexes if "gen" in saved_models[x]
-            ][0]
-            D_last_model = [
-                saved_models[x] for x in selected_indexes if "dis" in saved_models[x]
-            ][0]
-            saved_grids = os.listdir("repo/save/grid")
-            global_iterations = list(map(lambda x: int(x.split("_")[0]), saved_grids))
-            self.globalIter = self.config.save_img_every * max(global_iterations)
+            snapshots = checkpoint.load_manifest("repo/model")
+            if snapshots:
+                # the manifest records the latest snapshot, no need to list files.
+                self.last_iteration = snapshots[-1]["tick"]
+                self.globalIter = snapshots[-1]["globalIter"]
+                G_last_model = snapshots[-1]["files"]["gen"]
+                D_last_model = snapshots[-1]["files"]["dis"]
+            else:
+                # older runs without manifest: parse file names.
+                saved_models = [
+                    x for x in os.listdir("repo/model/") if x.endswith(".pth.tar")
+                ]
+                iterations = list(
+                    map(lambda x: int(x.split("_")[-1].split(".")[0][1:]), saved_models)
+                )
+                self.last_iteration = max(iterations)
+                selected_indexes = np.where(
+                    [x == self.last_iteration for x in iterations]
+                )[0]
+                G_last_model = [
+                    saved_models[x]
+                    for x in selected_indexes
+                    if "gen" in saved_models[x]
+                ][0]
+                D_last_model = [
+                    saved_models[x]
+                    for x in selected_indexes
+                    if "dis" in saved_models[x]
+                ][0]
+                saved_grids = os.listdir("repo/save/grid")
+                global_iterations = list(
+                    map(lambda x: int(x.split("_")[0]), saved_grids)
+                )
+                self.globalIter = self.config.save_img_every * max(global_iterations)
             print(
                 "Resuming after "
                 + str(self.last_iteration)
@@ -83,8 +228,12 @@ class trainer:
                 + str(self.globalIter)
                 + " iterations"
             )
-            G_weights = torch.load("repo/model/" + G_last_model)
-            D_weights = torch.load("repo/model/" + D_last_model)
+            G_weights = checkpoint.load(
+                "repo/model/" + G_last_model, mmap=self.config.flag_mmap_load
+            )
+            D_weights = checkpoint.load(
+                "repo/model/" + D_last_model, mmap=self.config.flag_mmap_load
+            )
             self.resuming = True
         else:
             self.resuming = False
@@ -99,35 +248,60 @@ class trainer:
         self.flag_flush_dis = False
         self.flag_add_noise = self.config.flag_add_noise
         self.flag_add_drift = self.config.flag_add_drift
+        self.amp = mixed_precision.precision_policy(
+            config.precision, "cuda" if self.use_cuda else "cpu"
+        )
+        self.memory_format = torch.contiguous_format
+        if config.flag_channels_last:
+            self.memory_format = torch.channels_last
 
         # network and cirterion
         self.G = net.Generator(config)
         self.D = net.Discriminator(config)
-        print("Generator structure: ")
-        print(self.G.model)
-        print("Discriminator structure: ")
-        print(self.D.model)
+        # smoothed generator: exponential moving average of G's weights.
+        self.Gs = copy.deepcopy(self.G)
+        self.Gs.requires_grad_(False)
+        if self.is_main:
+            print("Generator structure: ")
+            print(self.G.model)
+            print("Discriminator structure: ")
+            print(self.D.model)
         self.mse = torch.nn.MSELoss()
         if self.use_cuda:
             self.mse = self.mse.cuda()
-            torch.cuda.manual_seed(config.random_seed)
-            self.G = torch.nn.DataParallel(self.G, device_ids=[0]).cuda(device=0)
-            self.D = torch.nn.DataParallel(self.D, device_ids=[0]).cuda(device=0)
+            # self.z is drawn on the gpu: different latents on every rank.
+            torch.cuda.manual_seed(config.random_seed + dist_utils.get_rank())
+            self.G = self.G.cuda()
+            self.D = self.D.cuda()
+            self.Gs = self.Gs.cuda()
+
+        # rebuild the saved network structure before allocating anything for it.
+        if self.resuming:
+            self.resl = G_weights["resl"]
+            self.restore_structure(
+                min(floor(self.resl), self.max_resl),
+                G_weights["flag_flush_gen"],
+                G_weights["flag_flush_dis"],
+            )
 
         # define tensors, ship model to cuda, and get dataloader.
+        self.loader = DL.dataloader(config)
+        self.tuner = None
+        if config.flag_autotune:
+            self.tuner = autotune.batch_tuner(config, self.amp, self.memory_format)
         self.renew_everything()
         if self.resuming:
-            self.resl = G_weights["resl"]
             self.globalIter = G_weights["globalIter"]
             self.globalTick = G_weights["globalTick"]
             self.kimgs = G_weights["kimgs"]
             self.epoch = G_weights["epoch"]
             self.phase = G_weights["phase"]
-            self.fadein = G_weights["fadein"]
             self.complete = G_weights["complete"]
             self.flag_flush_gen = G_weights["flag_flush_gen"]
             self.flag_flush_dis = G_weights["flag_flush_dis"]
             self.stack = G_weights["stack"]
+            self.loader.epoch = self.epoch
+            self.last_snapshot_tick = self.globalTick
 
             print(
                 "Resuming at "
@@ -136,16 +310,62 @@ class trainer:
                 + str(self.epoch)
                 + " epochs"
             )
-            self.G.module.load_state_dict(G_weights["state_dict"])
-            self.D.module.load_state_dict(D_weights["state_dict"])
-            self.opt_g.load_state_dict(G_weights["optimizer"])
-            self.opt_d.load_state_dict(D_weights["optimizer"])
+            self.G.load_state_dict(G_weights["state_dict"])
+            if "smoothed_state_dict" in G_weights:
+                self.Gs.load_state_dict(G_weights["smoothed_state_dict"])
+            else:
+                self.Gs.load_state_dict(G_weights["state_dict"])
+            self.D.load_state_dict(D_weights["state_dict"])
+            if "scales" in G_weights:
+                # equalized learning rate scales, drawn when the layers were built.
+                net.load_scales(self.G, G_weights["scales"])
+                net.load_scales(self.Gs, G_weights["scales"])
+                net.load_scales(self.D, D_weights["scales"])
+            if "by_name" in G_weights["optimizer"]:
+                optim_utils.load_state_dict_by_name(
+                    self.opt_g, self.G, G_weights["optimizer"]
+                )
+                optim_utils.load_state_dict_by_name(
+                    self.opt_d, self.D, D_weights["optimizer"]
+                )
+            else:
+                try:
+                    self.opt_g.load_state_dict(G_weights["optimizer"])
+                    self.opt_d.load_state_dict(D_weights["optimizer"])
+                except ValueError:
+                    print("[!] optimizer state does not match the network, reset it.")
+            for target, model in [("gen", self.G), ("dis", self.D)]:
+                self.fadein[target] = dict(model.model.named_children()).get(
+                    "fadein_block"
+                )
+                alpha = G_weights["fadein"][target]
+                if self.fadein[target] is not None and alpha is not None:
+                    # older checkpoints stored the fade-in layer itself.
+                    self.fadein[target].alpha = getattr(alpha, "alpha", alpha)
+            del G_weights, D_weights
+
+        # image previews are written in the background.
+        self.preview = preview.preview_exporter()
 
         # tensorboard
-        self.use_tb = config.use_tb
+        self.use_tb = config.use_tb and self.is_main
         if self.use_tb:
             self.tb = tensorboard.tf_recorder()
 
+        # gradient penalty every reg_every D steps.
+        self.reg = regularization.lazy_regularizer(config)
+
+        # losses stay on the device, and are read every log_every steps.
+        self.metrics = metrics.metrics_accumulator()
+
+        # named spans around the stages of a training step.
+        self.profiler = profiler.step_profiler(
+            config.flag_profile and self.is_main,
+            trace_resl=config.profile_trace_resl,
+            trace_steps=config.profile_trace_steps,
+            recorder=self.tb if self.use_tb else None,
+        )
+
     def resl_scheduler(self):
         """
         this function will schedule image resolution(self.resl) progressively.
@@ -165,8 +385,10 @@ class trainer:
             self.stab_tick = self.config.stab_tick
 
         self.batchsize = self.loader.batchsize
+        # progress is counted in images over all ranks.
+        global_batchsize = self.loader.global_batchsize
         delta = 1.0 / (2 * self.trns_tick + 2 * self.stab_tick)
-        d_alpha = 1.0 * self.batchsize / self.trns_tick / self.TICK
+        d_alpha = 1.0 * global_batchsize / self.trns_tick / self.TICK
 
         # update alpha if fade-in layer exist.
         if self.fadein["gen"] is not None:
@@ -194,24 +416,27 @@ class trainer:
                 self.phase = "dstab"
 
         prev_kimgs = self.kimgs
-        self.kimgs = self.kimgs + self.batchsize
+        self.kimgs = self.kimgs + global_batchsize
         if (self.kimgs % self.TICK) < (prev_kimgs % self.TICK):
             self.globalTick = self.globalTick + 1
             if self.resuming and self.globalTick > self.last_iteration:
                 self.resuming = False
             # increase linearly every tick, and grow network structure.
             prev_resl = floor(self.resl)
-            f = open("continue.txt", "r")
-            if safe_reading(f):
-                f.close()
+            # read by rank 0 only, so that all ranks speed up (or skip) together.
+            request = 0
+            if self.is_main:
+                with open("continue.txt", "r") as f:
+                    request = safe_reading(f)
+                if request:
+                    with open("continue.txt", "w") as f:
+                        f.write("0")
+            if dist_utils.broadcast_object(request):
                 if self.phase[1:] == "trns":
                     self.accelerate = accelerate(self.accelerate)
                 else:
                     self.skip = True
-                f = open("continue.txt", "w")
-                f.write("0")
             self.resl = self.resl + delta
-            f.close()
             self.resl = max(2, min(10.5, self.resl))  # clamping, range: 4 ~ 1024
             # flush network.
             if (
@@ -223,13 +448,15 @@ class trainer:
                     self.fadein["gen"].update_alpha(d_alpha)
                     self.complete["gen"] = self.fadein["gen"].alpha * 100
                 self.flag_flush_gen = False
-                self.G.module.flush_network()  # flush G
-                # print(self.G.module.model)
-                # self.Gs.module.flush_network()         # flush Gs
+                self.G.flush_network()  # flush G
+                # print(self.G.model)
+                self.Gs.flush_network()  # flush Gs
+                optim_utils.sync_param_groups(self.opt_g, self.G.parameters())
                 self.fadein["gen"] = None
                 self.complete["gen"] = 0.0
                 self.phase = "dtrns"
-                print("flush gen, stop fadein gen, begin phase " + self.phase)
+                if self.is_main:
+                    print("flush gen, stop fadein gen, begin phase " + self.phase)
                 self.just_passed = True
             elif (
                 self.flag_flush_dis and floor(self.resl) != prev_resl and prev_resl != 2
@@ -238,31 +465,30 @@ class trainer:
                     self.fadein["dis"].update_alpha(d_alpha)
                     self.complete["dis"] = self.fadein["dis"].alpha * 100
                 self.flag_flush_dis = False
-                self.D.module.flush_network()  # flush and,
-                # print(self.D.module.model)
+                self.D.flush_network()  # flush and,
+                optim_utils.sync_param_groups(self.opt_d, self.D.parameters())
+                # print(self.D.model)
                 self.fadein["dis"] = None
                 self.complete["dis"] = 0.0
                 if floor(self.resl) < self.max_resl and self.phase != "final":
                     self.phase = "gtrns"
-                print("flush dis, stop fadein dis, begin phase " + self.phase)
+                if self.is_main:
+                    print("flush dis, stop fadein dis, begin phase " + self.phase)
                 self.just_passed = True
 
             # grow network.
             if floor(self.resl) != prev_resl and floor(self.resl) < self.max_resl + 1:
-                self.G.module.grow_network(floor(self.resl))
-                # self.Gs.grow_network(floor(self.resl))
-                self.D.module.grow_network(floor(self.resl))
+                self.G.grow_network(floor(self.resl))
+                self.grow_smoothed(floor(self.resl))
+                self.D.grow_network(floor(self.resl))
                 self.renew_everything()
-                self.fadein["gen"] = dict(self.G.module.model.named_children())[
-                    "fadein_block"
-                ]
-                self.fadein["dis"] = dict(self.D.module.model.named_children())[
-                    "fadein_block"
-                ]
+                self.fadein["gen"] = dict(self.G.model.named_children())["fadein_block"]
+                self.fadein["dis"] = dict(self.D.model.named_children())["fadein_block"]
                 self.flag_flush_gen = True
                 self.flag_flush_dis = True
                 self.just_passed = True
-                print("grow network, begin fadein phases")
+                if self.is_main:
+                    print("grow network, begin fadein phases")
 
             if (
                 floor(self.resl) >= self.max_resl
@@ -274,9 +500,26 @@ class trainer:
                 )
 
     def renew_everything(self):
+        # ship new model to cuda.
+        if self.use_cuda:
+            self.G = self.G.cuda()
+            self.D = self.D.cuda()
+            self.Gs = self.Gs.cuda()
+        if self.config.flag_channels_last:
+            # in place: the parameters keep their identity for the optimizers.
+            self.G = self.G.to(memory_format=self.memory_format)
+            self.D = self.D.to(memory_format=self.memory_format)
+            self.Gs = self.Gs.to(memory_format=self.memory_format)
+        # new blocks start from rank 0's weights on every rank.
+        for model in [self.G, self.D, self.Gs]:
+            dist_utils.broadcast_module(model)
+            custom_layers.set_generator(model, self.rng)
+
         # renew dataloader.
-        self.loader = DL.dataloader(config)
-        self.loader.renew(min(floor(self.resl), self.max_resl))
+        resl = min(floor(self.resl), self.max_resl)
+        if self.tuner is not None:
+            self.autotune_batch(resl)
+        self.loader.renew(resl)
 
         # define tensors
         self.z = torch.FloatTensor(self.loader.batchsize, self.nz)
@@ -296,7 +539,7 @@ class trainer:
             self.x_tilde = self.x.cuda()
             self.real_label = self.real_label.cuda()
             self.fake_label = self.fake_label.cuda()
-            torch.cuda.manual_seed(config.random_seed)
+            torch.cuda.manual_seed(config.random_seed + dist_utils.get_rank())
 
         # wrapping autograd Variable.
         self.x = Variable(self.x, requires_grad=True)
@@ -305,12 +548,12 @@ class trainer:
         self.real_label = Variable(self.real_label)
         self.fake_label = Variable(self.fake_label)
 
-        # ship new model to cuda.
-        if self.use_cuda:
-            self.G = self.G.cuda()
-            self.D = self.D.cuda()
-
         # optimizer
+        if self.config.flag_carry_optim and hasattr(self, "opt_g"):
+            # keep the adam moments of the already trained blocks.
+            optim_utils.sync_param_groups(self.opt_g, self.G.parameters())
+            optim_utils.sync_param_groups(self.opt_d, self.D.parameters())
+            return
         betas = (self.config.beta1, self.config.beta2)
         if self.optimizer == "adam":
             self.opt_g = Adam(
@@ -326,63 +569,69 @@ class trainer:
                 weight_decay=0.0,
             )
 
+    def restore_structure(self, resl, flag_flush_gen, flag_flush_dis):
+        # replay grow/flush up to resl. G (resp. D) is left in its fade-in state
+        # if it was not flushed yet when the snapshot was taken.
+        for r in range(3, resl + 1):
+            self.G.grow_network(r)
+            self.grow_smoothed(r)
+            self.D.grow_network(r)
+            if r < resl or not flag_flush_gen:
+                self.G.flush_network()
+                self.Gs.flush_network()
+            if r < resl or not flag_flush_dis:
+                self.D.flush_network()
+
+    def grow_smoothed(self, resl):
+        # grow Gs like G: existing blocks keep their averaged weights, new
+        # blocks start from G's weights, and the fade-in layer is shared with G
+        # so that both blend with the same alpha.
+        known = set(id(m) for m in self.Gs.modules())
+        self.Gs.grow_network(resl)
+        net.copy_new_modules(self.Gs, self.G, known)
+        self.Gs.requires_grad_(False)
+        if hasattr(self.Gs.model, "fadein_block"):
+            self.Gs.model.fadein_block = self.G.model.fadein_block
+
+    def autotune_batch(self, resl):
+        # rank 0 probes the grown networks, all ranks use its micro-batch size.
+        imsize = int(pow(2, resl))
+        batchsize = None
+        if self.is_main:
+            batchsize = self.tuner.tune(
+                self.G, self.D, imsize, self.loader.logical_batchsize(imsize)
+            )
+        batchsize = dist_utils.broadcast_object(batchsize)
+        self.loader.micro_batch_table[imsize] = batchsize
+
     def feed_interpolated_input(self, x):
+        if self.use_cuda:
+            x = x.cuda()
         if (
             self.phase == "gtrns"
             and floor(self.resl) > 2
             and floor(self.resl) <= self.max_resl
         ):
             alpha = self.complete["gen"] / 100.0
-            transform = transforms.Compose(
-                [
-                    transforms.ToPILImage(),
-                    transforms.Scale(
-                        size=int(pow(2, floor(self.resl) - 1)), interpolation=0
-                    ),  # 0: nearest
-                    transforms.Scale(
-                        size=int(pow(2, floor(self.resl))), interpolation=0
-                    ),  # 0: nearest
-                    transforms.ToTensor(),
-                ]
-            )
-            x_low = x.clone().add(1).mul(0.5)
-            for i in range(x_low.size(0)):
-                x_low[i] = transform(x_low[i]).mul(2).add(-1)
-            x = torch.add(x.mul(alpha), x_low.mul(1 - alpha))  # interpolated_x
-
-        if self.use_cuda:
-            return x.cuda()
-        else:
-            return x
+            x_low = interpolate_low_resl(x)
+            x = torch.lerp(x_low, x, alpha)  # interpolated_x
+        return x.contiguous(memory_format=self.memory_format)
 
     def add_noise(self, x):
         # TODO: support more method of adding noise.
         if self.flag_add_noise == False:
             return x
 
+        # moving average of D's output on fakes, kept on the device.
         if hasattr(self, "_d_"):
-            self._d_ = self._d_ * 0.9 + torch.mean(self.fx_tilde).item() * 0.1
+            self._d_ = self._d_ * 0.9 + torch.mean(self.fx_tilde.detach()) * 0.1
         else:
-            self._d_ = 0.0
-        strength = 0.2 * max(0, self._d_ - 0.5) ** 2
-        z = np.random.randn(*x.size()).astype(np.float32) * strength
-        z = (
-            Variable(torch.from_numpy(z)).cuda()
-            if self.use_cuda
-            else Variable(torch.from_numpy(z))
+            self._d_ = torch.zeros((), device=x.device)
+        strength = 0.2 * torch.clamp(self._d_ - 0.5, min=0) ** 2
+        noise = torch.randn(
+            x.size(), generator=self.rng, dtype=x.dtype, device=x.device
         )
-        return x + z
-
-    def _gradient_penalty(self, gradients):
-        # Gradients have shape (batch_size, num_channels, img_width, img_height),
-        # so flatten to easily take norm per example in batch
-        gradients = gradients.view(self.batchsize, -1)
-        # Derivatives of the gradient close to 0 can cause problems because of
-        # the square root, so manually calculate norm and add epsilon
-        gradients_norm = torch.sqrt(torch.sum(gradients ** 2, dim=1) + 1e-12)
-
-        # Return gradient penalty
-        return self.wgan_lambda * ((gradients_norm - 1) ** 2).mean()
+        return x + noise * strength
 
     def train(self):
         # noise for test.
@@ -397,16 +646,13 @@ class trainer:
                 range(
                     0,
                     (self.trns_tick * 2 + self.stab_tick * 2) * self.TICK,
-                    self.loader.batchsize,
-                )
+                    self.loader.global_batchsize,
+                ),
+                disable=not self.is_main,
             ):
                 if self.just_passed:
                     continue
                 self.globalIter = self.globalIter + 1
-                self.stack = self.stack + self.loader.batchsize
-                if self.stack > ceil(len(self.loader.dataset)):
-                    self.epoch = self.epoch + 1
-                    self.stack = int(self.stack % (ceil(len(self.loader.dataset))))
 
                 # reslolution scheduler.
                 self.resl_scheduler()
@@ -420,54 +666,90 @@ class trainer:
                 self.G.zero_grad()
                 self.D.zero_grad()
 
-                # update discriminator.
-                self.x.data = self.feed_interpolated_input(self.loader.get_batch())
-                if self.flag_add_noise:
-                    self.x = self.add_noise(self.x)
-                self.z.data.resize_(self.loader.batchsize, self.nz).normal_(0.0, 1.0)
-                self.x_tilde = self.G(self.z)
-
-                self.fx = self.D(self.x)
-                self.fx_tilde = self.D(self.x_tilde.detach())
-
-                loss_d = self.mse(self.fx.squeeze(), self.real_label) + self.mse(
-                    self.fx_tilde, self.fake_label
-                )
-
-                ### gradient penalty
-                gradients = torch_grad(
-                    outputs=self.fx,
-                    inputs=self.x,
-                    grad_outputs=torch.ones(self.fx.size()).cuda()
-                    if self.use_cuda
-                    else torch.ones(self.fx.size()),
-                    create_graph=True,
-                    retain_graph=True,
-                )[0]
-                gradient_penalty = self._gradient_penalty(gradients)
-                loss_d += gradient_penalty
-
-                ### epsilon penalty
-                epsilon_penalty = (self.fx ** 2).mean()
-                loss_d += epsilon_penalty * self.wgan_epsilon
-                loss_d.backward()
-                self.opt_d.step()
+                # update discriminator, accumulating the gradients of the
+                # micro-batches that make up the (logical) batch.
+                n_accum = self.loader.n_accum
+                z_micro = []
+                loss_d_sum = 0.0
+                # lazy regularization: weight of the penalties in this step (0: none).
+                reg_weight = self.reg.step(self.loader.imsize)
+                reg_batch = self.reg.sub_batch(self.loader.batchsize)
+                for micro in range(n_accum):
+                    with self.profiler.span("data"):
+                        batch = self.loader.get_batch("cuda" if self.use_cuda else None)
+                    with self.profiler.span("interpolate"):
+                        self.x.data = self.feed_interpolated_input(batch)
+                    self.epoch = self.loader.epoch
+                    self.stack = self.loader.stack
+                    if self.flag_add_noise:
+                        with self.profiler.span("add_noise"):
+                            self.x = self.add_noise(self.x)
+                    self.z.data.resize_(self.loader.batchsize, self.nz).normal_(
+                        0.0, 1.0
+                    )
+                    if n_accum > 1:
+                        z_micro.append(self.z.data.clone())
+                    loss_d, self.x_tilde, self.fx, self.fx_tilde = d_step_loss(
+                        self.G,
+                        self.D,
+                        self.x,
+                        self.z,
+                        self.real_label,
+                        self.fake_label,
+                        self.mse,
+                        self.amp,
+                        reg_weight,
+                        reg_batch,
+                        self.wgan_lambda,
+                        self.wgan_epsilon,
+                        fused=self.config.flag_fused_d,
+                        keep_g_graph=n_accum == 1,
+                        prof=self.profiler,
+                    )
+                    with self.profiler.span("backward_d"):
+                        self.amp.scale(loss_d / n_accum).backward()
+                    loss_d_sum = loss_d_sum + loss_d.detach()
+                loss_d = loss_d_sum / n_accum
+                with self.profiler.span("update_d"):
+                    dist_utils.all_reduce_grads(self.D.parameters())
+                    self.amp.step(self.opt_d)
 
                 # update generator.
-                fx_tilde = self.D(self.x_tilde)
-                loss_g = self.mse(fx_tilde.squeeze(), self.real_label.detach())
-                loss_g.backward()
-                self.opt_g.step()
-
-                # logging.
-                if (iter - 1) % 10:
+                loss_g_sum = 0.0
+                for micro in range(n_accum):
+                    loss_g = g_step_loss(
+                        self.G,
+                        self.D,
+                        self.x_tilde,
+                        z_micro[micro] if n_accum > 1 else None,
+                        self.real_label.detach(),
+                        self.mse,
+                        self.amp,
+                        prof=self.profiler,
+                    )
+                    with self.profiler.span("backward_g"):
+                        self.amp.scale(loss_g / n_accum).backward()
+                    loss_g_sum = loss_g_sum + loss_g.detach()
+                loss_g = loss_g_sum / n_accum
+                with self.profiler.span("update_g"):
+                    dist_utils.all_reduce_grads(self.G.parameters())
+                    self.amp.step(self.opt_g)
+                    self.amp.update()
+                with self.profiler.span("ema"):
+                    net.soft_copy_param(self.Gs, self.G, 1.0 - self.smoothing)
+
+                # logging: mean losses since the last log line.
+                if self.is_main:
+                    self.metrics.add(loss_d=loss_d, loss_g=loss_g)
+                if self.is_main and len(self.metrics) >= self.config.log_every:
+                    losses = self.metrics.flush()
                     log_msg = " [E:{0}][T:{1}][{2:6}/{3:6}]  errD: {4:.4f} | errG: {5:.4f} | [lr:{11:.5f}][cur:{6:.3f}][resl:{7:4}][{8}][{9:.1f}%][{10:.1f}%]".format(
                         self.epoch,
                         self.globalTick,
                         self.stack,
                         len(self.loader.dataset),
-                        loss_d.item(),
-                        loss_g.item(),
+                        losses["loss_d"],
+                        losses["loss_g"],
                         self.resl,
                         int(pow(2, floor(self.resl))),
                         self.phase,
@@ -476,104 +758,123 @@ class trainer:
                         self.lr,
                     )
                     tqdm.write(log_msg)
+                    if self.use_tb:
+                        for k, v in losses.items():
+                            self.tb.add_scalar("data/" + k, v, self.globalIter)
 
                 # save model.
-                self.snapshot("repo/model")
+                with self.profiler.span("snapshot"):
+                    self.snapshot("repo/model")
 
                 # save image grid.
-                if self.globalIter % self.config.save_img_every == 0:
-                    with torch.no_grad():
-                        x_test = self.G(self.z_test)
-                    utils.mkdir("repo/save/grid")
-                    utils.mkdir("repo/save/grid_real")
-                    utils.save_image_grid(
-                        x_test.data,
-                        "repo/save/grid/{}_{}_G{}_D{}.jpg".format(
-                            int(self.globalIter / self.config.save_img_every),
-                            self.phase,
-                            self.complete["gen"],
-                            self.complete["dis"],
-                        ),
-                    )
-                    if self.globalIter % self.config.save_img_every * 10 == 0:
-                        utils.save_image_grid(
-                            self.x.data,
-                            "repo/save/grid_real/{}_{}_G{}_D{}.jpg".format(
+                if self.is_main and self.globalIter % self.config.save_img_every == 0:
+                    with self.profiler.span("preview"):
+                        with torch.no_grad():
+                            x_test = self.Gs(self.z_test)
+                        self.preview.submit(
+                            x_test.data,
+                            "repo/save/grid/{}_{}_G{}_D{}.jpg".format(
                                 int(self.globalIter / self.config.save_img_every),
                                 self.phase,
                                 self.complete["gen"],
                                 self.complete["dis"],
                             ),
+                            ngrid=4,
                         )
-                    utils.mkdir("repo/save/resl_{}".format(int(floor(self.resl))))
-                    utils.mkdir("repo/save/resl_{}_real".format(int(floor(self.resl))))
-                    utils.save_image_single(
-                        x_test.data,
-                        "repo/save/resl_{}/{}_{}_G{}_D{}.jpg".format(
-                            int(floor(self.resl)),
-                            int(self.globalIter / self.config.save_img_every),
-                            self.phase,
-                            self.complete["gen"],
-                            self.complete["dis"],
-                        ),
-                    )
-                    if self.globalIter % self.config.save_img_every * 10 == 0:
-                        utils.save_image_single(
-                            self.x.data,
-                            "repo/save/resl_{}_real/{}_{}_G{}_D{}.jpg".format(
+                        if self.globalIter % self.config.save_img_every * 10 == 0:
+                            self.preview.submit(
+                                self.x.data,
+                                "repo/save/grid_real/{}_{}_G{}_D{}.jpg".format(
+                                    int(self.globalIter / self.config.save_img_every),
+                                    self.phase,
+                                    self.complete["gen"],
+                                    self.complete["dis"],
+                                ),
+                                ngrid=4,
+                            )
+                        self.preview.submit(
+                            x_test.data,
+                            "repo/save/resl_{}/{}_{}_G{}_D{}.jpg".format(
                                 int(floor(self.resl)),
                                 int(self.globalIter / self.config.save_img_every),
                                 self.phase,
                                 self.complete["gen"],
                                 self.complete["dis"],
                             ),
+                            ngrid=1,
                         )
+                        if self.globalIter % self.config.save_img_every * 10 == 0:
+                            self.preview.submit(
+                                self.x.data,
+                                "repo/save/resl_{}_real/{}_{}_G{}_D{}.jpg".format(
+                                    int(floor(self.resl)),
+                                    int(self.globalIter / self.config.save_img_every),
+                                    self.phase,
+                                    self.complete["gen"],
+                                    self.complete["dis"],
+                                ),
+                                ngrid=1,
+                            )
 
                 # tensorboard visualization.
                 if self.use_tb:
-                    with torch.no_grad():
-                        x_test = self.G(self.z_test)
-                    self.tb.add_scalar("data/loss_g", loss_g.item(), self.globalIter)
-                    self.tb.add_scalar("data/loss_d", loss_d.item(), self.globalIter)
-                    self.tb.add_scalar("tick/lr", self.lr, self.globalIter)
-                    self.tb.add_scalar(
-                        "tick/cur_resl", int(pow(2, floor(self.resl))), self.globalIter
-                    )
-                    """IMAGE GRID
-                    self.tb.add_image_grid('grid/x_test', 4, utils.adjust_dyn_range(x_test.data.float(), [-1,1], [0,1]), self.globalIter)
-                    self.tb.add_image_grid('grid/x_tilde', 4, utils.adjust_dyn_range(self.x_tilde.data.float(), [-1,1], [0,1]), self.globalIter)
-                    self.tb.add_image_grid('grid/x_intp', 4, utils.adjust_dyn_range(self.x.data.float(), [-1,1], [0,1]), self.globalIter)
-                    """
+                    with self.profiler.span("tensorboard"):
+                        self.record_tb()
+
+                self.profiler.step(
+                    self.globalTick, self.phase, min(floor(self.resl), self.max_resl)
+                )
             self.just_passed = False
 
-    def get_state(self, target):
-        if target == "gen":
-            state = {
-                "resl": self.resl,
-                "state_dict": self.G.module.state_dict(),
-                "optimizer": self.opt_g.state_dict(),
-            }
-            return state
-        elif target == "dis":
-            state = {
-                "resl": self.resl,
-                "state_dict": self.D.module.state_dict(),
-                "optimizer": self.opt_d.state_dict(),
-            }
-            return state
+        if self.ckpt_writer is not None:
+            self.ckpt_writer.close()
+        self.preview.close()
+        self.profiler.close()
+        if self.use_tb:
+            self.tb.close()
+        if self.is_main:
+            print("[preview] {}".format(self.preview.stats()))
+
+    def record_tb(self):
+        # scalars every display_tb_every iterations; G only runs when its
+        # images are actually recorded.
+        if self.globalIter % self.config.display_tb_every == 0:
+            self.tb.add_scalar("tick/lr", self.lr, self.globalIter)
+            for k, v in self.preview.stats().items():
+                self.tb.add_scalar("preview/" + k, v, self.globalIter)
+            self.tb.add_scalar(
+                "tick/cur_resl", int(pow(2, floor(self.resl))), self.globalIter
+            )
+        every = self.config.tb_image_every
+        if every > 0 and self.globalIter % every == 0:
+            with torch.no_grad():
+                x_test = self.Gs(self.z_test)
+            self.tb.add_image_grid("grid/x_test", 4, x_test, self.globalIter)
+            self.tb.add_image_grid("grid/x_tilde", 4, self.x_tilde, self.globalIter)
+            self.tb.add_image_grid("grid/x_intp", 4, self.x, self.globalIter)
+        every = self.config.tb_histogram_every
+        if every > 0 and self.globalIter % every == 0:
+            for prefix, model in [("G", self.G), ("D", self.D)]:
+                for name, p in model.named_parameters():
+                    self.tb.add_histogram(
+                        "{}/{}".format(prefix, name), p, self.globalIter
+                    )
 
     def get_state(self, target):
         if target == "gen":
             state = {
                 "resl": self.resl,
-                "state_dict": self.G.module.state_dict(),
-                "optimizer": self.opt_g.state_dict(),
+                "state_dict": self.G.state_dict(),
+                "smoothed_state_dict": self.Gs.state_dict(),
+                "scales": net.get_scales(self.G),
+                "optimizer": optim_utils.state_dict_by_name(self.opt_g, self.G),
                 "globalIter": self.globalIter,
                 "globalTick": self.globalTick,
                 "phase": self.phase,
                 "epoch": self.epoch,
+                "stack": self.stack,
                 "kimgs": self.kimgs,
-                "fadein": self.fadein,
+                "fadein": self.fadein_alpha(),
                 "complete": self.complete,
                 "flag_flush_gen": self.flag_flush_gen,
                 "flag_flush_dis": self.flag_flush_dis,
@@ -582,45 +883,80 @@ class trainer:
         elif target == "dis":
             state = {
                 "resl": self.resl,
-                "state_dict": self.D.module.state_dict(),
-                "optimizer": self.opt_d.state_dict(),
+                "state_dict": self.D.state_dict(),
+                "scales": net.get_scales(self.D),
+                "optimizer": optim_utils.state_dict_by_name(self.opt_d, self.D),
                 "globalIter": self.globalIter,
                 "globalTick": self.globalTick,
                 "phase": self.phase,
                 "epoch": self.epoch,
+                "stack": self.stack,
                 "kimgs": self.kimgs,
-                "fadein": self.fadein,
+                "fadein": self.fadein_alpha(),
                 "complete": self.complete,
                 "flag_flush_gen": self.flag_flush_gen,
                 "flag_flush_dis": self.flag_flush_dis,
             }
             return state
 
+    def fadein_alpha(self):
+        return {k: (None if v is None else v.alpha) for k, v in self.fadein.items()}
+
     def snapshot(self, path):
-        if not os.path.exists(path):
-            if os.name == "nt":
-                os.system("mkdir {}".format(path.replace("/", "\\")))
-            else:
-                os.system("mkdir -p {}".format(path))
-        # save every 100 tick if the network is in stab phase.
-        ndis = "dis_R{}_T{}.pth.tar".format(int(floor(self.resl)), self.globalTick)
-        ngen = "gen_R{}_T{}.pth.tar".format(int(floor(self.resl)), self.globalTick)
-        if self.globalTick % 50 == 0:
-            if self.phase == "gstab" or self.phase == "dstab" or self.phase == "final":
-                save_path = os.path.join(path, ndis)
-                if not os.path.exists(save_path):
-                    torch.save(self.get_state("dis"), save_path)
-                    save_path = os.path.join(path, ngen)
-                    torch.save(self.get_state("gen"), save_path)
-                    print("[snapshot] model saved @ {}".format(path))
+        # save every 50 tick if the network is in stab phase.
+        if self.globalTick % 50 != 0 or self.globalTick == self.last_snapshot_tick:
+            return
+        if not self.is_main:
+            return
+        if self.phase == "gstab" or self.phase == "dstab" or self.phase == "final":
+            if self.ckpt_writer is None:
+                self.ckpt_writer = checkpoint.checkpoint_writer(
+                    path, self.config.keep_last, self.config.keep_per_resl
+                )
+            self.last_snapshot_tick = self.globalTick
+            resl = int(floor(self.resl))
+            ndis = "dis_R{}_T{}.pth.tar".format(resl, self.globalTick)
+            ngen = "gen_R{}_T{}.pth.tar".format(resl, self.globalTick)
+            # serialization happens in the writer thread, on a host copy.
+            info = {
+                "resl": resl,
+                "tick": self.globalTick,
+                "globalIter": self.globalIter,
+                "phase": self.phase,
+                "kimgs": self.kimgs,
+            }
+            self.ckpt_writer.save(
+                info,
+                {
+                    "dis": (ndis, checkpoint.to_cpu(self.get_state("dis"))),
+                    "gen": (ngen, checkpoint.to_cpu(self.get_state("gen"))),
+                },
+            )
+
+
+def main(options):
+    # spawned processes parse their own command line: use the parent's options
+    # (and its time-based random seed) instead.
+    vars(config).update(vars(options))
+    dist_utils.init(config.dist_backend)
+    config.random_seed = dist_utils.broadcast_object(config.random_seed)
+    if dist_utils.is_main():
+        print("----------------- configuration -----------------")
+        for k, v in vars(config).items():
+            print("  {}: {}".format(k, v))
+        print("-------------------------------------------------")
+    # different latents and noise on every rank; the weights are broadcast.
+    rank = dist_utils.get_rank()
+    torch.manual_seed(config.random_seed + rank)
+    np.random.seed((config.random_seed + rank) % pow(2, 32))
+    torch.backends.cudnn.benchmark = True  # boost speed.
+    trainer(config).train()
+    dist_utils.cleanup()
 
 
 if __name__ == "__main__":
     ## perform training.
-    print("----------------- configuration -----------------")
-    for k, v in vars(config).items():
-        print("  {}: {}".format(k, v))
-    print("-------------------------------------------------")
-    torch.backends.cudnn.benchmark = True  # boost speed.
-    trainer = trainer(config)
-    trainer.train()
+    if config.n_gpu > 1 and "WORLD_SIZE" not in os.environ:
+        dist_utils.launch(main, config.n_gpu, (config,))  # one process per device.
+    else:
+        main(config)  # single process, or started by torchrun.
@@ -85,10 +85,7 @@ def make_summary(writer, key, value, step):
 
 
 def mkdir(path):
-    if os.name == "nt":
-        os.system("mkdir {}".format(path.replace("/", "\\")))
-    else:
-        os.system("mkdir -p {}".format(path))
+    os.makedirs(path, exist_ok=True)
 
 
 import torch